@@ -0,0 +1,128 @@
+from news_sender import NewsSender
+import sqlite3
+import threading
+import time
+import json
+import logging
+
+
+class ArticleCache:
+    """
+    Persistent on-disk cache of news API responses, in an SQLite file, so a
+    rerun of the app (e.g. after an email failure partway through) doesn't
+    pay for the same news queries again.
+
+    Entries are the JSON response for one query key.  An entry is fresh for
+    cache_ttl_sec after it was fetched; after that it's stale, but is kept
+    along with the response's ETag/Last-Modified headers so the request can
+    be revalidated with the server rather than re-downloaded.  No more than
+    cache_max_entries are kept; least recently used entries are evicted
+    first.
+    """
+
+    def __init__(self, cache_file: str, ttl_sec: float, max_entries: int,
+                 clock=time.time):
+        self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+        self.connection = sqlite3.connect(cache_file, check_same_thread=False,
+                                          timeout=30.0)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                "query_key TEXT PRIMARY KEY, "
+                                "response TEXT NOT NULL, "
+                                "etag TEXT, "
+                                "last_modified TEXT, "
+                                "fetched_at REAL NOT NULL, "
+                                "last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_lru "
+                                "ON responses (last_used)")
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(query_params: dict) -> str:
+        return json.dumps(query_params, sort_keys=True)
+
+    def get(self, query_key: str) -> (dict, dict):
+        """
+        Look up a cached response
+        :param query_key: key made from the query params, see make_key()
+        :return: tuple of the response if fresh (else None), and if the entry
+            is stale, the conditional request headers to revalidate it with
+            (else None)
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response, etag, last_modified, fetched_at FROM responses "
+                "WHERE query_key = ?", (query_key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, None
+            response, etag, last_modified, fetched_at = row
+            now = self.clock()
+            if now - fetched_at <= self.ttl_sec:
+                self.hits += 1
+                self.connection.execute("UPDATE responses SET last_used = ? "
+                                        "WHERE query_key = ?", (now, query_key))
+                self.connection.commit()
+                return json.loads(response), None
+            self.misses += 1
+            headers = {}
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+            return None, headers if len(headers) != 0 else None
+
+    def revalidated(self, query_key: str) -> dict:
+        """
+        The server says a stale entry is still good (304), so make it fresh again
+        :param query_key: key made from the query params, see make_key()
+        :return: the cached response, None if it's been evicted since get()
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses "
+                                          "WHERE query_key = ?", (query_key,)).fetchone()
+            if row is None:
+                return None
+            now = self.clock()
+            self.connection.execute("UPDATE responses SET fetched_at = ?, last_used = ? "
+                                    "WHERE query_key = ?", (now, now, query_key))
+            self.connection.commit()
+            self.revalidations += 1
+        return json.loads(row[0])
+
+    def put(self, query_key: str, response: dict, etag: str = None,
+            last_modified: str = None):
+        """
+        Save a response, evicting the least recently used entries if the
+        cache is over its size limit
+        """
+        with self.lock:
+            now = self.clock()
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                                    (query_key, json.dumps(response), etag,
+                                     last_modified, now, now))
+            excess = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0] \
+                - self.max_entries
+            if excess > 0:
+                self.connection.execute("DELETE FROM responses WHERE query_key IN "
+                                        "(SELECT query_key FROM responses "
+                                        "ORDER BY last_used LIMIT ?)", (excess,))
+                self.evictions += excess
+            self.connection.commit()
+
+    def stats(self) -> dict:
+        return {"cache_hits": self.hits,
+                "cache_misses": self.misses,
+                "cache_evictions": self.evictions,
+                "cache_revalidated": self.revalidations}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,177 @@
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import hashlib
+import re
+import sys
+import threading
+
+
+class ArticleIndex:
+    """
+    Run-scoped index of every article fetched, keyed by normalized URL and by
+    a fingerprint of the title, so the same story showing up under several
+    topics (e.g. "Tesla" and "Powerwall"), or from a copy with a slightly
+    different URL, is one article object in memory, referenced by every topic
+    list it's in.  Articles with different URLs are only merged on their
+    titles if they're also from the same source or the same site.
+
+    Since duplicates are then the same object, each email can be deduplicated
+    cheaply by identity: see select().  A topic that loses an article to an
+    earlier topic in the email gets its next-ranked article instead; topics
+    are fetched with dedup_backfill_articles extra articles for that.
+    """
+
+    # query params that only say where the click came from
+    TRACKING_PARAMS = re.compile(r"utm_.*|fbclid|gclid|mc_cid|mc_eid|ref|cmpid|ocid")
+    WORD = re.compile(r"\w+")
+    STOP_WORDS = frozenset("a an and are as at be by for from has in is it its of on or "
+                           "that the to was were will with".split())
+    # a trailing " - CNN" or " | Reuters" on a headline
+    SOURCE_SUFFIX = re.compile(r"\s+[-|–—]\s+[^-|–—]{1,40}$")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_url: dict[str, dict] = {}
+        self.by_title: dict[bytes, dict] = {}
+        # ids of the news dicts interned or being interned: the dict, so the id
+        # stays unique, and an Event set once its articles have been swapped
+        self.news_interned: dict[int, tuple[dict, threading.Event]] = {}
+        self.articles_indexed = 0
+        self.duplicates_merged = 0
+        self.bytes_saved = 0
+        self.duplicates_removed = 0
+
+    @classmethod
+    def normalize_url(cls, url: str) -> str:
+        """
+        :return: the URL without the scheme, www., fragment, tracking params or
+            trailing slash, lowercased host
+        """
+        if not url:
+            return ""
+        parts = urlsplit(str(url).strip())
+        host = parts.netloc.lower()
+        if host.startswith("www."):
+            host = host[4:]
+        query = urlencode(sorted((name, value) for name, value in
+                                 parse_qsl(parts.query, keep_blank_values=True)
+                                 if not cls.TRACKING_PARAMS.fullmatch(name.lower())))
+        return urlunsplit(("", host, parts.path.rstrip("/"), query, ""))
+
+    @classmethod
+    def title_fingerprint(cls, title: str) -> bytes:
+        """
+        :return: hash of the title's significant words in order, ignoring
+            case, punctuation and a trailing source name; None if there's no
+            title to go on
+        """
+        if not title:
+            return None
+        title = cls.SOURCE_SUFFIX.sub("", str(title))
+        # in order: "Tesla sues Ford" isn't "Ford sues Tesla"
+        words = [word for word in cls.WORD.findall(title.casefold())
+                 if word not in cls.STOP_WORDS]
+        if len(words) < 3:
+            # too short to say two articles are the same story
+            return None
+        return hashlib.blake2b(" ".join(words).encode("utf-8"), digest_size=8).digest()
+
+    @staticmethod
+    def same_origin(article: dict, other: dict) -> bool:
+        """
+        :return: True if the two articles are from the same source, going by
+            the source name, or failing that the URL's host
+        """
+        names = [str((a.get("source") or {}).get("name") or "").casefold()
+                 for a in (article, other)]
+        if names[0] != "" and names[0] == names[1]:
+            return True
+        hosts = [ArticleIndex.normalize_url(a.get("url")).partition("/")[0]
+                 for a in (article, other)]
+        return hosts[0] != "" and hosts[0] == hosts[1]
+
+    @staticmethod
+    def article_size(article: dict) -> int:
+        return sys.getsizeof(article) + sum(sys.getsizeof(value) for value in article.values())
+
+    def intern(self, article: dict) -> dict:
+        """
+        :return: the index's copy of the article, adding it if it's new
+        """
+        url_key = ArticleIndex.normalize_url(article.get("url"))
+        title_key = ArticleIndex.title_fingerprint(article.get("title"))
+        with self.lock:
+            known = self.by_url.get(url_key) if url_key else None
+            if known is None and title_key is not None:
+                known = self.by_title.get(title_key)
+                # a headline alone doesn't make two sites' articles the same story
+                if known is not None and not ArticleIndex.same_origin(known, article):
+                    known = None
+            if known is not None:
+                if known is not article:
+                    self.duplicates_merged += 1
+                    self.bytes_saved += ArticleIndex.article_size(article)
+                if url_key:
+                    self.by_url.setdefault(url_key, known)
+                return known
+            self.articles_indexed += 1
+            if url_key:
+                self.by_url[url_key] = article
+            if title_key is not None:
+                self.by_title[title_key] = article
+            return article
+
+    def intern_news(self, news: dict) -> dict:
+        """
+        Swap a topic's articles for the index's copies, the first time the
+        topic's news is seen; anyone else passing the same news in meanwhile
+        waits for that to be done
+        :param news: a topic's news, from the TopicCache
+        :return: the same news dict
+        """
+        with self.lock:
+            interned = self.news_interned.get(id(news))
+            if interned is None:
+                done = threading.Event()
+                self.news_interned[id(news)] = (news, done)
+        if interned is not None:
+            interned[1].wait()
+            return news
+        try:
+            news["articles"][:] = [self.intern(article) for article in news["articles"]]
+        finally:
+            done.set()
+        return news
+
+    def select(self, topics_news: dict, max_articles: int) -> dict:
+        """
+        Pick the articles for one email: each topic's top max_articles, in
+        the subscriber's topic order, skipping any article already listed
+        under an earlier topic, and backfilling with the next-ranked one
+        :param topics_news: dict of topic -> the topic's (interned) news
+        :param max_articles: most articles per topic
+        :return: dict of topic -> the topic's news, with just the articles picked
+        """
+        articles_seen = set()
+        duplicates = 0
+        selected = {}
+        for topic, news in topics_news.items():
+            picked = []
+            for article in news["articles"]:
+                if len(picked) >= max_articles:
+                    break
+                if id(article) in articles_seen:
+                    duplicates += 1
+                    continue
+                articles_seen.add(id(article))
+                picked.append(article)
+            selected[topic] = news | {"articles": picked}
+        if duplicates != 0:
+            with self.lock:
+                self.duplicates_removed += duplicates
+        return selected
+
+    def stats(self) -> dict:
+        return {"articles_indexed": self.articles_indexed,
+                "articles_merged": self.duplicates_merged,
+                "article_bytes_saved": self.bytes_saved,
+                "email_duplicates_removed": self.duplicates_removed}
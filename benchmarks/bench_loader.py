@@ -0,0 +1,109 @@
+"""
+Benchmark: load time and peak memory of the subscription loaders.
+
+Compares the pandas path (Subscriptions.load_subscriptions: pd.read_excel ->
+numpy object array -> topic lists) with the streaming SubscriptionLoader, for
+Excel, CSV and JSON Lines files.  Each measurement runs in its own process, so
+peak RSS isn't polluted by the others.
+
+    python benchmarks/bench_loader.py [rows]
+"""
+import csv
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+TOPICS = ["Tesla", "Ford", "Powerwall", "Ukraine", "Micropython", "Subaru",
+          "Star Trek", "James Taylor", "Lindsey Stirling", "Whipped Cream"]
+
+
+def make_rows(count: int):
+    rand = random.Random(42)
+    for i in range(count):
+        yield (f"First{i}", f"Last{i}", f"subscriber{i}@example.com",
+               ", ".join(rand.sample(TOPICS, rand.randint(1, 6))))
+
+
+def write_files(count: int, directory: str) -> dict:
+    import openpyxl
+    files = {"xlsx": os.path.join(directory, "subs.xlsx"),
+             "csv": os.path.join(directory, "subs.csv"),
+             "jsonl": os.path.join(directory, "subs.jsonl")}
+    header = ("First Name", "Last Name", "Email", "Topics of Interest (comma-separated)")
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for row in make_rows(count):
+        sheet.append(row)
+    workbook.save(files["xlsx"])
+    with open(files["csv"], "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(make_rows(count))
+    with open(files["jsonl"], "w", encoding="utf-8") as file:
+        for first, last, email, topics in make_rows(count):
+            file.write(json.dumps({"first_name": first, "last_name": last,
+                                   "email": email, "topics": topics}) + "\n")
+    return files
+
+
+def measure(method: str, filename: str):
+    """ Runs in the child process: load the file, print the results as JSON """
+    start = time.perf_counter()
+    first_record_sec = None
+    count = 0
+    if method == "pandas":
+        import numpy as np
+        import pandas as pd
+        subscriptions_array = np.array(pd.read_excel(filename))
+        for row in subscriptions_array:
+            topics_list = row[3].split(",")
+            for i in range(0, len(topics_list) - 1):
+                topics_list[i] = topics_list[i].strip()
+            row[3] = topics_list
+        first_record_sec = time.perf_counter() - start
+        count = len(subscriptions_array)
+    else:
+        from subscription_loader import SubscriptionLoader
+        from subscription_record import TopicTable
+        for _ in SubscriptionLoader.iter_subscriptions(filename, TopicTable()):
+            if first_record_sec is None:
+                first_record_sec = time.perf_counter() - start
+            count += 1
+    print(json.dumps({"records": count,
+                      "first_record_sec": round(first_record_sec, 4),
+                      "total_sec": round(time.perf_counter() - start, 4),
+                      "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                                           / 1024, 1)}))
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"Writing {rows} rows of test subscriptions...")
+        files = write_files(rows, directory)
+        runs = [("pandas", files["xlsx"]), ("streaming", files["xlsx"]),
+                ("streaming", files["csv"]), ("streaming", files["jsonl"])]
+        print(f"{'loader':<10} {'file':<6} {'records':>8} {'1st rec s':>10} "
+              f"{'total s':>8} {'peak MB':>8}")
+        for method, filename in runs:
+            output = subprocess.run([sys.executable, __file__, "--measure", method, filename],
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output)
+            print(f"{method:<10} {os.path.splitext(filename)[1][1:]:<6} "
+                  f"{result['records']:>8} {result['first_record_sec']:>10} "
+                  f"{result['total_sec']:>8} {result['peak_rss_mb']:>8}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3])
+    else:
+        main()
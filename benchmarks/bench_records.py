@@ -0,0 +1,67 @@
+"""
+Benchmark: memory per subscriber of the subscription record types.
+
+Compares the old numpy object array rows (first name, last name, email, list
+of topic strings, as Subscriptions.load_subscriptions used to build them) with
+SubscriptionRecords whose topics are IDs into a shared TopicTable, at 100k and
+1M subscribers.
+
+    python benchmarks/bench_records.py [count ...]
+"""
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from subscription_record import SubscriptionRecord, TopicTable
+
+TOPICS = [f"Topic number {i}" for i in range(500)]
+
+
+def make_rows(count: int):
+    rand = random.Random(42)
+    for i in range(count):
+        yield (f"First{i}", f"Last{i}", f"subscriber{i}@example.com",
+               ", ".join(rand.sample(TOPICS, rand.randint(1, 6))))
+
+
+def build_numpy_rows(count: int):
+    import numpy as np
+    array = np.array(list(make_rows(count)), dtype=object)
+    for row in array:
+        # each row gets its own list of its own topic strings
+        row[3] = [topic.strip() for topic in row[3].split(",")]
+    return array
+
+
+def build_records(count: int):
+    topic_table = TopicTable()
+    return [SubscriptionRecord(first, last, email,
+                               [topic.strip() for topic in topics.split(",")], topic_table)
+            for first, last, email, topics in make_rows(count)]
+
+
+def measure(builder, count: int) -> int:
+    tracemalloc.start()
+    built = builder(count)
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del built
+    return current
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [100000, 1000000]
+    print(f"{'subscribers':>11} {'numpy rows MB':>14} {'records MB':>11} "
+          f"{'bytes/sub before':>17} {'bytes/sub after':>16}")
+    for count in counts:
+        before = measure(build_numpy_rows, count)
+        after = measure(build_records, count)
+        print(f"{count:>11} {before / 2**20:>14.1f} {after / 2**20:>11.1f} "
+              f"{before / count:>17.0f} {after / count:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Microbenchmark: email renders per second, before and after the
+EmailRenderer's per-topic block caching.
+
+"Before" is the old EmailContent.add_news_table, which built every body with
+string += and re-rendered the same topic rows for every subscriber.  Both are
+run on newsapi-sized article payloads, for subscribers drawn from a shared
+pool of topics.
+
+    python benchmarks/bench_render.py [subscribers] [topics]
+"""
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from email_content import EmailContent
+from email_renderer import EmailRenderer
+from subscription_record import SubscriptionRecord, TopicTable
+
+
+def make_news(topic_count: int, articles_per_topic: int) -> dict:
+    rand = random.Random(42)
+    words = "the a electric battery market shares rose fell after report quarter " \
+            "company new launch update sources said analysts expect".split()
+    news = {}
+    for i in range(topic_count):
+        topic = f"Topic {i}"
+        news[topic] = {"topic": topic, "articles": [
+            {"title": " ".join(rand.choices(words, k=12)).capitalize(),
+             "description": " ".join(rand.choices(words, k=40)).capitalize() + " & more...",
+             "url": f"https://news.example.com/{i}/{j}/{'-'.join(rand.choices(words, k=6))}"}
+            for j in range(articles_per_topic)]}
+    return news
+
+
+def old_news_table(retrieved_articles: dict) -> str:
+    body = '<table><tr>' \
+           '<th style="width:15%">Topic</th>' \
+           '<th style="width:30%">Headline</th>' \
+           '<th>Summary</th></tr>\n'
+    for topic in retrieved_articles.keys():
+        topic_articles = retrieved_articles[topic]
+        if len(topic_articles["articles"]) == 0:
+            body += f'<tr><td><b>{topic}</b></td>' \
+                    '<td><i>No articles found for today</i></td><td/></tr>'
+            continue
+        first_one = True
+        for article in topic_articles["articles"]:
+            body += f'<tr><td><b>{topic}</b></td>' if first_one else '<tr><td></td>'
+            first_one = False
+            body += f'<td>{article["title"]}</td>' \
+                    f'<td>{article["description"]} - <a href="{article["url"]}">' \
+                    '<i>go to article</i></a></td></tr>\n'
+    return body + '</table>'
+
+
+def main():
+    subscriber_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    topic_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    news = make_news(topic_count, 10)
+    rand = random.Random(7)
+    topic_table = TopicTable()
+    subscriptions = [SubscriptionRecord(f"First{i}", f"Last{i}", f"sub{i}@example.com",
+                                        rand.sample(list(news), 5), topic_table)
+                     for i in range(subscriber_count)]
+    newssender = SimpleNamespace(max_topics_per_subscription=5, debug=False)
+
+    start = time.perf_counter()
+    for subscription in subscriptions:
+        body = EmailContent.BODY_HEAD
+        body += f"<body><p>Good day, {subscription.firstname}!</p>\n"
+        body += old_news_table({topic: news[topic] for topic in subscription.topics})
+        body += EmailContent.CLOSING_BOILERPLATE
+    before = subscriber_count / (time.perf_counter() - start)
+
+    renderer = EmailRenderer()
+    start = time.perf_counter()
+    for subscription in subscriptions:
+        email_content = EmailContent(subscription, newssender, renderer)
+        email_content.build_email_content({topic: news[topic] for topic in subscription.topics})
+    after = subscriber_count / (time.perf_counter() - start)
+
+    print(f"{subscriber_count} subscribers, {topic_count} topics, 10 articles/topic")
+    print(f"before (string +=, no caching): {before:10.0f} renders/sec")
+    print(f"after (cached topic blocks):    {after:10.0f} renders/sec")
+    print(f"speedup: {after / before:.1f}x, {renderer.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark: news source requests per topic, one query per topic vs topics
+batched into combined (OR) queries by BatchingNewsSource.
+
+Subscribers are drawn from a shared pool of topics with Zipf-like
+popularity, and run through a NewsFetcher and TopicCache the way the
+pipeline does it: prefetch each subscriber's topics as it's read, and get
+them a queue's length (LOOKAHEAD subscribers) later.  The FakeNewsSource
+takes SEARCH_LATENCY_SEC per search, and counts the searches, as
+newsapi.org would count requests; like newsapi.org, it returns no more
+than a page (FakeNewsSource.MAX_PAGE_SIZE) of articles per search.
+Every batch size has to deliver the same number of articles as no
+batching.
+
+    python benchmarks/bench_sources.py [subscribers] [topics]
+"""
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from news_fetcher import NewsFetcher
+from news_sources import BatchingNewsSource, FakeNewsSource
+from run_metrics import RunMetrics
+from topic_cache import TopicCache
+
+LOOKAHEAD = 100
+SEARCH_LATENCY_SEC = 0.02
+
+
+def make_subscriptions(subscriber_count: int, topic_count: int) -> list[list[str]]:
+    rand = random.Random(7)
+    topics = [f"Topic {i}" for i in range(topic_count)]
+    weights = [1.0 / (rank + 1) for rank in range(topic_count)]
+    return [list(dict.fromkeys(rand.choices(topics, weights, k=5)))
+            for _ in range(subscriber_count)]
+
+
+def run(subscriptions: list[list[str]], batch_size: int) -> dict:
+    newssender = SimpleNamespace(max_articles_per_topic=10, dedup_backfill_articles=3,
+                                 fetch_max_in_flight=4,
+                                 date_str="2024-01-01", sort_order="relevancy",
+                                 metrics=RunMetrics())
+    fake_source = FakeNewsSource(newssender, latency_sec=SEARCH_LATENCY_SEC)
+    source = BatchingNewsSource(fake_source, batch_size) if batch_size > 1 else fake_source
+    fetcher = NewsFetcher(newssender, source)
+    topic_cache = TopicCache(newssender, fetcher)
+    start = time.perf_counter()
+    articles = 0
+    for i, topics in enumerate(subscriptions):
+        topic_cache.prefetch(topics)
+        if i >= LOOKAHEAD:
+            articles += sum(len(topic_cache.get(topic)["articles"])
+                            for topic in subscriptions[i - LOOKAHEAD])
+    for topics in subscriptions[-LOOKAHEAD:]:
+        articles += sum(len(topic_cache.get(topic)["articles"]) for topic in topics)
+    elapsed = time.perf_counter() - start
+    fetcher.close()
+    return {"requests": fake_source.searches,
+            "topics": topic_cache.topics_fetched,
+            "articles": articles,
+            "seconds": elapsed}
+
+
+def main():
+    subscriber_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    topic_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    subscriptions = make_subscriptions(subscriber_count, topic_count)
+    print(f"{subscriber_count} subscribers, {topic_count} topics in the pool")
+    baseline = None
+    baseline_articles = None
+    for batch_size in (1, 5, 10, 20):
+        result = run(subscriptions, batch_size)
+        baseline_articles = baseline_articles or result["articles"]
+        # batching is only worth it if every topic still gets all its articles
+        assert result["articles"] == baseline_articles, \
+            f"batch size {batch_size}: {result['articles']} articles delivered, " \
+            f"{baseline_articles} without batching"
+        per_topic = result["requests"] / result["topics"]
+        baseline = baseline or result["requests"]
+        print(f"batch size {batch_size:3}: {result['requests']:6} requests for "
+              f"{result['topics']} topics, {per_topic:.3f} requests/topic, "
+              f"{baseline / result['requests']:5.1f}x fewer, "
+              f"{result['articles']} articles delivered, {result['seconds']:.2f} sec")
+
+
+if __name__ == "__main__":
+    main()
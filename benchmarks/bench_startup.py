@@ -0,0 +1,61 @@
+"""
+Startup benchmark: how long `import main` takes, from python -X importtime,
+and which modules it pulls in.  The heavy dependencies (pandas, numpy,
+requests, openpyxl) should only be imported on the code paths that need
+them, so they mustn't show up here; if they do, or the import takes longer
+than the budget, this exits with status 1, so it can be run as a check.
+
+    python benchmarks/bench_startup.py [budget_ms] [runs]
+"""
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HEAVY_MODULES = ("pandas", "numpy", "requests", "openpyxl")
+
+
+def import_times() -> dict:
+    """
+    :return: dict of top-level module -> cumulative import time in microseconds,
+        for one fresh interpreter importing main
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 250.0
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    all_times = [import_times() for _ in range(runs)]
+    main_ms = sorted(times["main"] for times in all_times)[runs // 2] / 1000.0
+    times = all_times[-1]
+    print(f"import main: {main_ms:.1f} ms (median of {runs}), {len(times)} modules, "
+          f"budget {budget_ms:.0f} ms")
+    print("slowest app modules (cumulative ms):")
+    app_modules = {os.path.splitext(name)[0] for name in os.listdir(REPO_DIR)
+                   if name.endswith(".py")}
+    for module, cumulative in sorted(((module, cumulative) for module, cumulative in times.items()
+                                      if module in app_modules),
+                                     key=lambda item: item[1], reverse=True)[:10]:
+        print(f"  {module:24} {cumulative / 1000.0:8.1f}")
+    heavy = sorted({module for module in times if module.split(".")[0] in HEAVY_MODULES})
+    failed = False
+    if len(heavy) != 0:
+        print(f"FAIL: heavy modules imported at startup: {heavy[:10]}")
+        failed = True
+    if main_ms > budget_ms:
+        print(f"FAIL: import main took {main_ms:.1f} ms, over the {budget_ms:.0f} ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+End to end load test: a full run of main.py (Subscriptions.process_subscriptions,
+fetch -> render -> send) against local stand-ins, so it needs no network,
+newsapi.org key or email account.
+
+- a synthetic subscriptions CSV file: rows subscribers, each with 1 to 5
+  topics drawn from a pool of topics with Zipf-distributed popularity
+- a fake newsapi.org server (HTTP, on localhost), which makes up articles
+  for any query, OR queries included, after --api-latency-ms, and counts the
+  requests
+- an SMTP sink (on localhost), which accepts and counts the emails
+
+The app runs in its own process, with the news cache off, so every run
+starts cold.  Reported: subscribers/sec, API calls, emails, the app's peak
+RSS, and the per-stage latencies from the run's metrics.  The results are
+written as JSON (by default benchmarks/results/loadtest-<commit>.json), and
+--compare prints them against an earlier results file, e.g. from another
+commit.
+
+    python benchmarks/loadtest.py [--rows N] [--topics N] [--zipf S]
+        [--api-latency-ms MS] [--set config_key=value ...]
+        [--output FILE] [--compare FILE] [--keep]
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+STAGE_HISTOGRAMS = ("fetch_stage_seconds", "render_stage_seconds", "send_stage_seconds",
+                    "subscriber_seconds", "newsapi_request_seconds", "smtp_send_seconds")
+# the metrics to compare between results files, and whether bigger is better
+COMPARED = (("subscribers_per_sec", True), ("seconds", False), ("api_calls", False),
+            ("peak_rss_mb", False))
+
+
+def write_subscriptions(filename: str, rows: int, topic_count: int, zipf_s: float):
+    """
+    Write the synthetic subscriptions CSV file, in the app's column layout
+    """
+    rand = random.Random(42)
+    topics = [f"Topic {rank}" for rank in range(topic_count)]
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) ** zipf_s
+                                            for rank in range(topic_count)))
+    with open(filename, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(("First Name", "Last Name", "Email",
+                         "Topics of Interest (comma-separated)"))
+        for i in range(rows):
+            picked = rand.choices(topics, cum_weights=cum_weights, k=rand.randint(1, 5))
+            writer.writerow((f"First{i}", f"Last{i}", f"subscriber{i}@example.com",
+                             ", ".join(dict.fromkeys(picked))))
+
+
+class FakeNewsApi(ThreadingHTTPServer):
+    """
+    Stand-in for newsapi.org's /v2/everything: each topic in the q param
+    (a topic, or "topic" OR "topic" ...) gets its share of pageSize made-up
+    articles, with the topic in the title so a batched query can be split
+    back up by topic
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency_sec: float):
+        super().__init__(("127.0.0.1", 0), FakeNewsApiHandler)
+        self.latency_sec = latency_sec
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v2/everything"
+
+    @staticmethod
+    def articles(query: str, page_size: int) -> list[dict]:
+        topics = [topic.strip().strip('"') for topic in query.split(" OR ")]
+        per_topic = max(1, page_size // len(topics))
+        return [{"source": {"id": None, "name": "Fake News"},
+                 "title": f"{topic} story {i}: what happened with {topic} yesterday",
+                 "description": f"All about {topic}, part {i}.",
+                 "url": f"https://news.example.com/{topic.replace(' ', '-').lower()}/{i}",
+                 "publishedAt": "2024-01-01T00:00:00Z"}
+                for topic in topics for i in range(per_topic)][:page_size]
+
+
+class FakeNewsApiHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        params = parse_qs(urlsplit(self.path).query)
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency_sec)
+        articles = FakeNewsApi.articles(params.get("q", [""])[0],
+                                        int(params.get("pageSize", ["10"])[0]))
+        body = json.dumps({"status": "ok", "totalResults": len(articles),
+                           "articles": articles}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """
+    Minimal SMTP server that accepts every email and just counts it
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SmtpSinkHandler)
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes_received = 0
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 sink ESMTP")
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.reply("250-sink")
+                self.reply("250 8BITMIME")
+            elif command == b"DATA":
+                self.reply("354 go ahead")
+                size = 0
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                with self.server.lock:
+                    self.server.messages += 1
+                    self.server.bytes_received += size
+                self.reply("250 OK")
+            elif command == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply("250 OK")
+
+
+def start(server: socketserver.BaseServer) -> socketserver.BaseServer:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_config(directory: str, subscriptions_file: str, news_api: FakeNewsApi,
+                smtp_sink: SmtpSink, settings: dict) -> str:
+    """
+    :return: config file for the run: the example config, pointed at the
+        stand-ins and the work directory
+    """
+    with open(os.path.join(REPO_DIR, "files", "config_example.json"), encoding="utf-8") as file:
+        config = json.load(file)
+    output = os.path.join(directory, "output_files")
+    config.update(email_pwd="", debug="false", subscriptions_excel_file=subscriptions_file,
+                  logfile=os.path.join(output, "NewsSender.log"),
+                  news_source="newsapi", news_api_base_url=news_api.url,
+                  fetch_requests_per_sec=10000.0, cache_file="",
+                  smtp_host="127.0.0.1", smtp_port=smtp_sink.port, smtp_use_ssl="false",
+                  journal_file=os.path.join(output, "send_journal.sqlite"),
+                  subscriptions_snapshot_file="",
+                  metrics_json_file=os.path.join(output, "metrics.json"),
+                  metrics_prometheus_file="")
+    config.update(settings)
+    filename = os.path.join(directory, "config.json")
+    with open(filename, "w", encoding="utf-8") as file:
+        json.dump(config, file, indent=2)
+    return filename
+
+
+def run(args: argparse.Namespace, directory: str) -> dict:
+    subscriptions_file = os.path.join(directory, "subscriptions.csv")
+    os.makedirs(os.path.join(directory, "output_files"))
+    print(f"Writing {args.rows} subscribers, {args.topics} topics, Zipf s={args.zipf}...")
+    write_subscriptions(subscriptions_file, args.rows, args.topics, args.zipf)
+    news_api = start(FakeNewsApi(args.api_latency_ms / 1000.0))
+    smtp_sink = start(SmtpSink())
+    try:
+        config_file = make_config(directory, subscriptions_file, news_api, smtp_sink,
+                                  dict(args.set))
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, "main.py"), "--config", config_file],
+                       cwd=directory, check=True)
+        seconds = time.perf_counter() - start_time
+    finally:
+        news_api.shutdown()
+        smtp_sink.shutdown()
+    with open(os.path.join(directory, "output_files", "metrics.json"), encoding="utf-8") as file:
+        metrics = json.load(file)
+    stages = {name: {key: histogram[key] for key in ("count", "mean", "p50", "p95", "max")}
+              for name, histogram in metrics["histograms"].items()
+              if name in STAGE_HISTOGRAMS}
+    return {"subscribers": metrics["stats"].get("subscrip_proc_ok", 0),
+            "seconds": round(seconds, 3),
+            "subscribers_per_sec": round(args.rows / seconds, 1),
+            "api_calls": news_api.requests,
+            "emails": smtp_sink.messages,
+            "email_bytes": smtp_sink.bytes_received,
+            # only the app's process is waited on, so this is its peak; Linux reports KB
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            "stages": stages,
+            "stats": metrics["stats"]}
+
+
+def git_commit() -> str:
+    result = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+                            capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else "unknown"
+
+
+def print_results(results: dict):
+    print(f"{results['subscribers']} subscribers in {results['seconds']} sec: "
+          f"{results['subscribers_per_sec']} subscribers/sec, {results['api_calls']} API calls, "
+          f"{results['emails']} emails, peak RSS {results['peak_rss_mb']} MB")
+    print(f"{'stage':<26} {'count':>8} {'mean s':>9} {'p50 s':>8} {'p95 s':>8} {'max s':>8}")
+    for name, stage in results["stages"].items():
+        print(f"{name:<26} {stage['count']:>8} {stage['mean']:>9.4f} {stage['p50']:>8.4f} "
+              f"{stage['p95']:>8.4f} {stage['max']:>8.4f}")
+
+
+def print_comparison(results: dict, baseline_file: str):
+    with open(baseline_file, encoding="utf-8") as file:
+        baseline = json.load(file)
+    if baseline["params"] != results["params"]:
+        print(f"note: {baseline_file} was run with different params: {baseline['params']}")
+    print(f"{'vs ' + baseline['commit']:<26} {'before':>10} {'after':>10} {'change':>8}")
+    for name, bigger_is_better in COMPARED:
+        before, after = baseline["results"][name], results["results"][name]
+        change = (after - before) / before * 100.0 if before else 0.0
+        better = change == 0.0 or (change > 0.0) == bigger_is_better
+        print(f"{name:<26} {before:>10} {after:>10} {change:>+7.1f}% {'' if better else '(worse)'}")
+
+
+def parse_setting(setting: str) -> tuple:
+    name, _, value = setting.partition("=")
+    if name == "" or value == "":
+        raise argparse.ArgumentTypeError(f"{setting}: expected config_key=value")
+    return name, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end load test against local stand-ins")
+    parser.add_argument("--rows", type=int, default=10000, help="subscribers (default 10000)")
+    parser.add_argument("--topics", type=int, default=2000,
+                        help="topics in the pool (default 2000)")
+    parser.add_argument("--zipf", type=float, default=1.1,
+                        help="Zipf exponent of the topics' popularity (default 1.1)")
+    parser.add_argument("--api-latency-ms", type=float, default=20.0,
+                        help="fake newsapi.org response time (default 20)")
+    parser.add_argument("--set", metavar="KEY=VALUE", type=parse_setting, action="append",
+                        default=[], help="config setting for the run, e.g. news_batch_size=20")
+    parser.add_argument("--output", metavar="FILE",
+                        help="results file (default benchmarks/results/loadtest-<commit>.json)")
+    parser.add_argument("--compare", metavar="FILE", help="earlier results file to compare to")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the work directory (subscriptions, config, log, metrics)")
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix="loadtest-")
+    try:
+        results = {"commit": git_commit(),
+                   "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "params": {"rows": args.rows, "topics": args.topics, "zipf": args.zipf,
+                              "api_latency_ms": args.api_latency_ms,
+                              "settings": dict(args.set)},
+                   "results": run(args, directory)}
+    finally:
+        if args.keep:
+            print(f"Work directory kept: {directory}")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+    print_results(results["results"])
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"loadtest-{results['commit']}.json")
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {output}")
+    if args.compare is not None:
+        print_comparison(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+from collections import deque, namedtuple
+from email.utils import getaddresses
+import threading
+import time
+
+# a queued email: the message, its Future, its recipient domain, and times deferred so far
+ScheduledEmail = namedtuple("ScheduledEmail", ["msg", "future", "domain", "deferrals"])
+
+
+class DomainQueue:
+    """
+    The emails waiting for one recipient domain, and the domain's send rate
+    """
+
+    # sends kept to measure the domain's actual rate by
+    RECENT_SENDS = 20
+
+    def __init__(self, domain: str, rate: float):
+        self.domain = domain
+        self.pending: deque[ScheduledEmail] = deque()
+        # messages/sec allowed, None for no limit
+        self.rate = rate
+        self.next_send_time = 0.0
+        self.recent_sends: deque[float] = deque(maxlen=DomainQueue.RECENT_SENDS)
+        self.first_send_time = None
+        self.sent = 0
+        self.failed = 0
+        self.deferred = 0
+
+    def observed_rate(self) -> float:
+        """
+        :return: messages/sec over the recent sends, 1.0 if there aren't enough to go on
+        """
+        if len(self.recent_sends) < 2 or self.recent_sends[-1] <= self.recent_sends[0]:
+            return 1.0
+        return (len(self.recent_sends) - 1) / (self.recent_sends[-1] - self.recent_sends[0])
+
+    def stats(self) -> dict:
+        elapsed = self.recent_sends[-1] - self.first_send_time if self.sent > 1 else 0.0
+        return {"sent": self.sent,
+                "failed": self.failed,
+                "deferred": self.deferred,
+                "msgs_per_sec": round(self.sent / elapsed, 2) if elapsed > 0 else 0.0,
+                "rate_limit": round(self.rate, 2) if self.rate is not None else 0.0}
+
+
+class DomainScheduler:
+    """
+    Send queue for the SmtpPool, split up by recipient domain.  Gmail, AOL
+    and corporate mail servers each have their own limits, and a domain that
+    pushes back shouldn't hold up mail to everyone else.
+
+    - Each domain has its own queue, and the pool's workers take turns
+      between the domains that are ready to send, round robin.
+    - Each domain's rate is controlled AIMD style: a temporary (4xx) refusal
+      halves the domain's rate and pauses it (doubling each time the same
+      email is refused), and the email goes back to the head of the queue
+      to be retried; each success adds RATE_STEP messages/sec back, up to
+      max_rate.  A domain starts at max_rate, or unlimited if max_rate is 0,
+      until it first pushes back.
+    - An email deferred max_deferrals times fails.
+
+    The per-domain throughput and deferral counts are in stats().
+    """
+
+    MIN_RATE = 0.1
+    RATE_STEP = 0.5
+
+    def __init__(self, max_rate: float = 0.0, max_deferrals: int = 5,
+                 backoff_sec: float = 1.0, clock=time.monotonic):
+        """
+        :param max_rate: most messages/sec sent to any one domain, 0 for no limit
+        :param max_deferrals: times an email can be deferred before it fails
+        :param backoff_sec: pause for a domain after its first temporary refusal
+        :param clock: time source, e.g. a fake one for testing
+        """
+        self.max_rate = max_rate if max_rate > 0 else None
+        self.max_deferrals = max_deferrals
+        self.backoff_sec = backoff_sec
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.domains: dict[str, DomainQueue] = {}
+        # domains with emails waiting, in turn order
+        self.active: deque[str] = deque()
+        self.in_flight = 0
+        self.closed = False
+
+    @staticmethod
+    def recipient_domain(msg) -> str:
+        """
+        :param msg: the EmailMessage or RawEmail
+        :return: the (first) recipient's domain, lowercased
+        """
+        to_addrs = msg.to_addrs if hasattr(msg, "to_addrs") else \
+            [address for _, address in getaddresses(msg.get_all("To", []))]
+        if len(to_addrs) == 0:
+            return ""
+        return to_addrs[0].rpartition("@")[2].strip().rstrip(">").lower()
+
+    def domain_queue(self, domain: str) -> DomainQueue:
+        domain_queue = self.domains.get(domain)
+        if domain_queue is None:
+            domain_queue = self.domains[domain] = DomainQueue(domain, self.max_rate)
+        return domain_queue
+
+    def put(self, msg, future):
+        domain = DomainScheduler.recipient_domain(msg)
+        with self.condition:
+            self.queue(ScheduledEmail(msg, future, domain, 0), at_head=False)
+
+    def queue(self, email: ScheduledEmail, at_head: bool):
+        domain_queue = self.domain_queue(email.domain)
+        if len(domain_queue.pending) == 0:
+            self.active.append(email.domain)
+        if at_head:
+            domain_queue.pending.appendleft(email)
+        else:
+            domain_queue.pending.append(email)
+        self.condition.notify()
+
+    def get(self) -> ScheduledEmail:
+        """
+        Wait for the next email that can be sent: the next domain's turn, out
+        of the ones not paused or over their rate
+        :return: the email, None once closed and everything's been sent
+        """
+        with self.condition:
+            while True:
+                now = self.clock()
+                wait_sec = None
+                for _ in range(len(self.active)):
+                    domain_queue = self.domains[self.active[0]]
+                    # this domain goes to the back of the line either way
+                    self.active.rotate(-1)
+                    # an email given up on doesn't wait for its domain, it's only dropped
+                    cancelled = domain_queue.pending[0].future.cancelled()
+                    if domain_queue.next_send_time > now and not cancelled:
+                        wait_sec = min(wait_sec or float("inf"), domain_queue.next_send_time - now)
+                        continue
+                    email = domain_queue.pending.popleft()
+                    if len(domain_queue.pending) == 0:
+                        self.active.remove(domain_queue.domain)
+                    if domain_queue.rate is not None and not cancelled:
+                        domain_queue.next_send_time = \
+                            max(now, domain_queue.next_send_time) + 1.0 / domain_queue.rate
+                    self.in_flight += 1
+                    return email
+                if self.closed and len(self.active) == 0 and self.in_flight == 0:
+                    # wake the other workers up to finish too
+                    self.condition.notify_all()
+                    return None
+                self.condition.wait(wait_sec)
+
+    def sent(self, email: ScheduledEmail):
+        with self.condition:
+            domain_queue = self.domains[email.domain]
+            now = self.clock()
+            domain_queue.sent += 1
+            domain_queue.recent_sends.append(now)
+            if domain_queue.first_send_time is None:
+                domain_queue.first_send_time = now
+            if domain_queue.rate is not None and domain_queue.rate != self.max_rate:
+                # additive increase, back up to the limit
+                domain_queue.rate += DomainScheduler.RATE_STEP
+                if self.max_rate is not None:
+                    domain_queue.rate = min(domain_queue.rate, self.max_rate)
+
+    def failed(self, email: ScheduledEmail):
+        with self.condition:
+            self.domains[email.domain].failed += 1
+
+    def defer(self, email: ScheduledEmail) -> bool:
+        """
+        The domain temporarily refused the email: slow the domain down, and
+        requeue the email to try again
+        :return: False if the email has been deferred too many times already,
+            and should fail
+        """
+        if email.deferrals >= self.max_deferrals:
+            return False
+        with self.condition:
+            domain_queue = self.domains[email.domain]
+            domain_queue.deferred += 1
+            # multiplicative decrease, from the limit or from what it was really getting
+            current_rate = domain_queue.rate if domain_queue.rate is not None \
+                else domain_queue.observed_rate()
+            domain_queue.rate = max(DomainScheduler.MIN_RATE, current_rate / 2)
+            pause_sec = max(1.0 / domain_queue.rate, self.backoff_sec * 2 ** email.deferrals)
+            domain_queue.next_send_time = self.clock() + pause_sec
+            self.queue(email._replace(deferrals=email.deferrals + 1), at_head=True)
+            return True
+
+    def done(self):
+        """
+        A worker is finished with the email it got from get(), whatever happened to it
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {"smtp_deferrals": sum(domain_queue.deferred
+                                          for domain_queue in self.domains.values()),
+                    "smtp_domains": len(self.domains),
+                    "smtp_domain_stats": {domain: domain_queue.stats()
+                                          for domain, domain_queue in sorted(self.domains.items())}}
+
+    def close(self):
+        """
+        No more emails are coming: get() returns None once the queued ones are sent
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
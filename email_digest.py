@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from email.message import EmailMessage
+from email import policy
+from smtp_pool import RawEmail
+import threading
+import quopri
+
+
+class EmailDigest:
+    """
+    Bulk digest mode: subscribers whose effective topic lists (their topic
+    lists cut down to max_topics_per_subscription) are the same get the same
+    news table and closing, so that shared part of the MIME body is built and
+    quoted-printable encoded once per bucket of subscribers, and the encoded
+    bytes are reused for every subscriber in the bucket.  Only the headers and
+    the personalized greeting are encoded per subscriber.
+
+    Quoted-printable encodes line by line, and the greeting part always ends
+    in a newline, so the two encoded parts can simply be joined.
+
+    Up to max_buckets encoded bodies are kept, least recently used dropped first.
+    """
+
+    CRLF = b"\r\n"
+
+    def __init__(self, sender_account: str, max_buckets: int):
+        self.sender_account = sender_account
+        self.max_buckets = max(1, max_buckets)
+        self.encoded_bodies: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.buckets_seen: set = set()
+        self.bytes_encoded = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def encode(html_text: str) -> bytes:
+        return quopri.encodestring(html_text.encode("utf-8")).replace(b"\n", EmailDigest.CRLF)
+
+    def encoded_body(self, bucket_key, shared_html: str) -> bytes:
+        """
+        :param bucket_key: the bucket's effective topic list
+        :param shared_html: the part of the body shared by the bucket
+        :return: the encoded shared part, from the cache if the bucket has been
+            seen before
+        """
+        with self.lock:
+            self.buckets_seen.add(bucket_key)
+            encoded = self.encoded_bodies.get(bucket_key)
+            if encoded is not None:
+                self.encoded_bodies.move_to_end(bucket_key)
+                self.bytes_saved += len(encoded)
+                return encoded
+        encoded = EmailDigest.encode(shared_html)
+        with self.lock:
+            self.bytes_encoded += len(encoded)
+            self.encoded_bodies[bucket_key] = encoded
+            if len(self.encoded_bodies) > self.max_buckets:
+                self.encoded_bodies.popitem(last=False)
+        return encoded
+
+    def build_message(self, subject: str, personal_html: str, bucket_key,
+                      shared_html: str, recipients: list[str]) -> RawEmail:
+        """
+        Build the ready-to-send message out of the personalized headers and
+        greeting, and the bucket's pre-encoded shared body
+        :param subject: subject line
+        :param personal_html: start of the body, through the personalized greeting
+        :param bucket_key: the subscriber's effective topic list
+        :param shared_html: rest of the body, the same for the whole bucket
+        :param recipients: a list of recipients
+        :return: the message, as bytes ready for the SMTP DATA command
+        """
+        headers = EmailMessage(policy=policy.SMTP)
+        headers['Subject'] = subject
+        headers['From'] = self.sender_account
+        headers['To'] = ", ".join(recipients)
+        headers['MIME-Version'] = "1.0"
+        headers['Content-Type'] = 'text/html; charset="utf-8"'
+        headers['Content-Transfer-Encoding'] = "quoted-printable"
+        if not personal_html.endswith("\n"):
+            personal_html += "\n"
+        data = b"".join([headers.as_bytes(), EmailDigest.encode(personal_html),
+                         self.encoded_body(bucket_key, shared_html)])
+        return RawEmail(self.sender_account, list(recipients), data)
+
+    def stats(self) -> dict:
+        return {"digest_buckets": len(self.buckets_seen),
+                "digest_bytes_encoded": self.bytes_encoded,
+                "digest_bytes_saved": self.bytes_saved}
@@ -0,0 +1,80 @@
+import html
+import threading
+
+
+class EmailRenderer:
+    """
+    Renders the news table part of the emails.  Lots of subscribers share
+    the same topics, so each topic's block of table rows is rendered (and
+    HTML-escaped) once per run and cached; each email's table is then just
+    a join of the cached blocks for the subscriber's topics.
+
+    One renderer is shared by all the render threads in a run.
+    """
+
+    TABLE_HEAD = '<table><tr>' \
+                 '<th style="width:15%">Topic</th>' \
+                 '<th style="width:30%">Headline</th>' \
+                 '<th>Summary</th></tr>\n'
+    TABLE_TAIL = '</table>'
+
+    def __init__(self):
+        # (topic, ids of the articles) -> (articles, rendered rows).  The
+        # articles are kept so their ids can't be reused by other articles
+        self.fragments: dict[tuple, tuple] = {}
+        self.lock = threading.Lock()
+        self.fragments_rendered = 0
+        self.fragments_reused = 0
+
+    def news_table(self, retrieved_articles: dict) -> str:
+        """
+        :param retrieved_articles: dict of topic -> the topic's news from the TopicCache
+        :return: the HTML news table for an email
+        """
+        return "".join([EmailRenderer.TABLE_HEAD] +
+                       [self.topic_fragment(topic, topic_news["articles"])
+                        for topic, topic_news in retrieved_articles.items()] +
+                       [EmailRenderer.TABLE_TAIL])
+
+    def topic_fragment(self, topic: str, articles: list) -> str:
+        """
+        The table rows for one topic, rendered the first time they're needed
+        :param topic: the topic, as the subscriber spelled it
+        :param articles: the topic's articles
+        :return: the HTML table rows
+        """
+        # emails are deduplicated (see ArticleIndex), so two emails can have
+        # different picks of the same topic's articles
+        key = (topic, tuple(id(article) for article in articles))
+        cached = self.fragments.get(key)
+        if cached is not None:
+            with self.lock:
+                self.fragments_reused += 1
+            return cached[1]
+        fragment = EmailRenderer.render_topic(topic, articles)
+        with self.lock:
+            self.fragments[key] = (articles, fragment)
+            self.fragments_rendered += 1
+        return fragment
+
+    @staticmethod
+    def render_topic(topic: str, articles: list) -> str:
+        topic_cell = f'<td><b>{html.escape(str(topic))}</b></td>'
+        if len(articles) == 0:
+            return f'<tr>{topic_cell}<td><i>No articles found for today</i></td><td/></tr>'
+        rows = []
+        for article in articles:
+            rows.append(f'<tr>{topic_cell if len(rows) == 0 else "<td></td>"}'
+                        f'<td>{EmailRenderer.escape(article.get("title"))}</td>'
+                        f'<td>{EmailRenderer.escape(article.get("description"))} - '
+                        f'<a href="{EmailRenderer.escape(article.get("url"))}">'
+                        '<i>go to article</i></a></td></tr>\n')
+        return "".join(rows)
+
+    @staticmethod
+    def escape(value) -> str:
+        return "" if value is None else html.escape(str(value), quote=True)
+
+    def stats(self) -> dict:
+        return {"topic_blocks_rendered": self.fragments_rendered,
+                "topic_blocks_reused": self.fragments_reused}
@@ -0,0 +1,173 @@
+from news_sender import NewsSender
+from smtp_pool import RawEmail, SmtpPool
+from email.message import EmailMessage
+from email.utils import getaddresses
+from email import policy
+from collections import deque
+import threading
+import logging
+import mmap
+import re
+import struct
+import time
+
+
+class SpoolWriter:
+    """
+    Writes rendered emails to a spool instead of sending them, so rendering
+    can be decoupled from delivery: a big run is spooled, and the spool is
+    then handed to the MTA in bulk, or replayed through the SMTP pool by a
+    SpoolSender.
+
+    The spool is a single mbox file (mboxrd quoting, CRLF line endings, each
+    message exactly the bytes that go to the SMTP DATA command), written
+    sequentially through a large buffer, plus an offset index next to it
+    (spool file + ".idx"): for each message, its offset and length in the
+    mbox, and its envelope sender and recipients.  So the spool can be read
+    back without parsing the mbox.
+    """
+
+    INDEX_MAGIC = b"NFSPOOL1"
+    # message offset, message length, envelope from length, envelope to length
+    INDEX_ENTRY = struct.Struct("<QIHI")
+    BUFFER_BYTES = 1 << 20
+    CRLF = b"\r\n"
+    FROM_LINE = re.compile(rb"^(>*From )", re.MULTILINE)
+
+    def __init__(self, spool_file: str, buffer_bytes: int = BUFFER_BYTES):
+        self.spool_file = spool_file
+        self.lock = threading.Lock()
+        self.mbox = open(spool_file, "wb", buffering=buffer_bytes)
+        self.index = open(SpoolWriter.index_file(spool_file), "wb", buffering=buffer_bytes)
+        self.index.write(SpoolWriter.INDEX_MAGIC)
+        self.position = 0
+        self.messages = 0
+        self.bytes_written = 0
+
+    @staticmethod
+    def index_file(spool_file: str) -> str:
+        return spool_file + ".idx"
+
+    @staticmethod
+    def envelope(msg) -> RawEmail:
+        """
+        :param msg: the EmailMessage, with its To/From headers set, or a RawEmail
+        :return: the message as a RawEmail, ready for the SMTP DATA command
+        """
+        if isinstance(msg, RawEmail):
+            return msg
+        to_addrs = [address for _, address in getaddresses(msg.get_all("To", []))]
+        return RawEmail(msg["From"], to_addrs, msg.as_bytes(policy=policy.SMTP))
+
+    def write(self, msg: EmailMessage | RawEmail) -> (bool, str):
+        """
+        Add a message to the spool
+        :param msg: the EmailMessage, with its To/From headers set, or a RawEmail
+        :return: (True, status msg), like a send
+        """
+        raw_email = SpoolWriter.envelope(msg)
+        from_addr = raw_email.from_addr.encode("utf-8")
+        to_addrs = ",".join(raw_email.to_addrs).encode("utf-8")
+        # mboxrd: a "From " line in the message gets another ">"
+        data = SpoolWriter.FROM_LINE.sub(rb">\1", raw_email.data)
+        from_line = b"From " + from_addr + b" " + \
+            time.asctime(time.gmtime()).encode("ascii") + SpoolWriter.CRLF
+        with self.lock:
+            offset = self.position + len(from_line)
+            self.mbox.write(from_line)
+            self.mbox.write(data)
+            self.mbox.write(SpoolWriter.CRLF)
+            self.position = offset + len(data) + len(SpoolWriter.CRLF)
+            self.index.write(SpoolWriter.INDEX_ENTRY.pack(offset, len(data), len(from_addr),
+                                                          len(to_addrs)))
+            self.index.write(from_addr)
+            self.index.write(to_addrs)
+            self.messages += 1
+            self.bytes_written += len(data)
+        return True, "spooled"
+
+    def stats(self) -> dict:
+        return {"spool_messages": self.messages,
+                "spool_bytes": self.bytes_written}
+
+    def close(self):
+        with self.lock:
+            self.mbox.close()
+            self.index.close()
+
+
+class SpoolSender:
+    """
+    Replays a spool written by SpoolWriter through the SMTP pool.  The mbox
+    is memory-mapped, and each message is sliced straight out of it using the
+    index, so the spool is never read in or parsed as a whole.  No more than
+    max_in_flight messages are queued on the pool at a time.
+    """
+
+    UNQUOTE_FROM_LINE = re.compile(rb"^>(>*From )", re.MULTILINE)
+
+    def __init__(self, spool_file: str, smtp_pool: SmtpPool, max_in_flight: int = 100):
+        self.spool_file = spool_file
+        self.smtp_pool = smtp_pool
+        self.max_in_flight = max(1, max_in_flight)
+        self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
+        self.sent = 0
+        self.failed = 0
+
+    def read_index(self) -> list[tuple]:
+        """
+        :return: list of (offset, length, envelope from, envelope to list), one
+            per message
+        """
+        with open(SpoolWriter.index_file(self.spool_file), "rb") as file:
+            index = file.read()
+        if not index.startswith(SpoolWriter.INDEX_MAGIC):
+            raise ValueError(f"{self.spool_file}: not a spool index")
+        entries = []
+        position = len(SpoolWriter.INDEX_MAGIC)
+        entry_size = SpoolWriter.INDEX_ENTRY.size
+        while position + entry_size <= len(index):
+            offset, length, from_len, to_len = \
+                SpoolWriter.INDEX_ENTRY.unpack_from(index, position)
+            position += entry_size
+            from_addr = index[position:position + from_len].decode("utf-8")
+            position += from_len
+            to_addrs = index[position:position + to_len].decode("utf-8").split(",")
+            position += to_len
+            entries.append((offset, length, from_addr, to_addrs))
+        return entries
+
+    def send(self, start: int = 0) -> dict:
+        """
+        Send the spooled messages
+        :param start: index of the first message to send, e.g. to pick up
+            after a replay that was cut short
+        :return: stats: messages in the spool, sent, and failed
+        """
+        entries = self.read_index()
+        in_flight: deque = deque()
+        with open(self.spool_file, "rb") as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as spool:
+            for number, (offset, length, from_addr, to_addrs) in \
+                    enumerate(entries[start:], start):
+                data = SpoolSender.UNQUOTE_FROM_LINE.sub(rb"\1", spool[offset:offset + length])
+                in_flight.append((number, to_addrs,
+                                  self.smtp_pool.submit(RawEmail(from_addr, to_addrs, data))))
+                if len(in_flight) >= self.max_in_flight:
+                    self.wait(in_flight.popleft())
+            while len(in_flight) != 0:
+                self.wait(in_flight.popleft())
+        stats = {"spool_messages": len(entries),
+                 "spool_sent": self.sent,
+                 "spool_failed": self.failed}
+        self.logger.info(f"Spool {self.spool_file} replayed: {stats}")
+        return stats
+
+    def wait(self, in_flight: tuple):
+        number, to_addrs, future = in_flight
+        sent, status = future.result()
+        if sent:
+            self.sent += 1
+        else:
+            self.failed += 1
+            self.logger.error(f"Spooled message {number} to {to_addrs} not sent: {status}")
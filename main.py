@@ -1,4 +1,130 @@
 from subscriptions import Subscriptions
+from news_sender import NewsSender
+from sharding import Shard, run_workers
+from scheduler_daemon import NewsDaemon
+from mail_spool import SpoolWriter, SpoolSender
+import argparse
+import signal
+import sys
+import cProfile
+import pstats
 
-subs = Subscriptions()
-subs.process_subscriptions()
+
+def shard_arg(shard_spec: str) -> Shard:
+    try:
+        return Shard.parse(shard_spec)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Email the day's news to the subscribers")
+    parser.add_argument("--config", default=NewsSender.CONFIG_FILENAME,
+                        help=f"config file (default {NewsSender.CONFIG_FILENAME})")
+    parser.add_argument("--check-config", action="store_true",
+                        help="check the config file and exit, without connecting to the "
+                             "email server")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="check the config and every subscription and exit, without "
+                             "fetching news or sending email")
+    parser.add_argument("--resume", action="store_true",
+                        help="resume today's run, skipping the subscribers already sent to")
+    parser.add_argument("--shard", metavar="i/N", type=shard_arg,
+                        help="only process shard i (from 0) of N of the subscribers, "
+                             "split by a hash of the email address")
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+                        help="split the run between N worker processes")
+    parser.add_argument("--daemon", action="store_true",
+                        help="stay resident and do the run every day at the configured "
+                             "daemon_run_time")
+    parser.add_argument("--spool", metavar="FILE",
+                        help="write the emails to FILE (an indexed mbox) instead of sending "
+                             "them, without connecting to the email server")
+    parser.add_argument("--send-spool", metavar="FILE",
+                        help="send the emails spooled to FILE by --spool, and exit")
+    parser.add_argument("--metrics-json", metavar="FILE",
+                        help="write the run's metrics summary to FILE as JSON")
+    parser.add_argument("--prometheus", metavar="FILE",
+                        help="write the run's metrics to FILE in Prometheus text format")
+    parser.add_argument("--profile", metavar="FILE", nargs="?", const="output_files/profile.prof",
+                        help="run under cProfile, dump the stats to FILE "
+                             "(default output_files/profile.prof)")
+    args = parser.parse_args()
+    if args.daemon and args.workers > 1:
+        parser.error("--workers can't be used with --daemon")
+    if args.spool is not None and (args.daemon or args.workers > 1):
+        parser.error("--spool can't be used with --daemon or --workers")
+    if args.send_spool is not None and (args.spool is not None or args.daemon
+                                        or args.workers > 1):
+        parser.error("--send-spool can't be used with --spool, --daemon or --workers")
+    return args
+
+
+def check(args: argparse.Namespace) -> int:
+    """
+    --check-config and --dry-run: nothing is fetched or sent, and the email
+    server isn't connected to.  A bad config exits with status 1 straight
+    away, see NewsSender
+    :return: exit status, 1 if there are bad or duplicate email addresses
+    """
+    subs = Subscriptions(args.config, connect=False)
+    print(f"Config {args.config} OK")
+    if not args.dry_run:
+        return 0
+    stats = subs.check_subscriptions()
+    print(f"Subscriptions {subs.newssender.subscriptions_excel_file}: "
+          + ", ".join(f"{name} {value}" for name, value in stats.items()))
+    return 1 if stats["bad_emails"] + stats["duplicate_emails"] != 0 else 0
+
+
+def send_spool(args: argparse.Namespace) -> dict:
+    """
+    --send-spool: replay a spool written by --spool through the email connections
+    :return: the replay's stats
+    """
+    newssender = NewsSender(args.config)
+    try:
+        return SpoolSender(args.send_spool, newssender.smtp_pool,
+                           max_in_flight=4 * newssender.smtp_pool_size).send()
+    finally:
+        newssender.close_connection()
+
+
+def run(args: argparse.Namespace) -> dict:
+    shard = args.shard if args.shard is not None else Shard()
+    if args.daemon:
+        # stop cleanly on a kill; the journal lets the next start pick up from here
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        NewsDaemon(args.config, args.shard).run_forever()
+        return {}
+    if args.workers > 1:
+        return run_workers(args.config, shard, args.workers, args.resume)
+    if args.send_spool is not None:
+        return send_spool(args)
+    subs = Subscriptions(args.config, connect=args.spool is None)
+    if args.spool is not None:
+        subs.newssender.spool = SpoolWriter(args.spool)
+    if args.shard is not None:
+        subs.shard = shard
+    if args.metrics_json is not None:
+        subs.newssender.metrics_json_file = args.metrics_json
+    if args.prometheus is not None:
+        subs.newssender.metrics_prometheus_file = args.prometheus
+    return subs.process_subscriptions(resume=args.resume)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.check_config or args.dry_run:
+        sys.exit(check(args))
+    if args.profile is None:
+        run(args)
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            run(args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
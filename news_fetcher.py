@@ -0,0 +1,105 @@
+from news_sender import NewsSender
+from news_sources import NewsSource
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+import logging
+
+
+class NewsFetcher:
+    """
+    Concurrent fetch engine for the configured NewsSource (newsapi.org unless
+    news_source says otherwise).  Topic queries are issued in parallel from a
+    bounded thread pool (fetch_max_in_flight in the config); throttling,
+    retries and caching are up to the source, see NewsApiSource.
+
+    If the source takes several topics per query (news_batch_size over 1, see
+    BatchingNewsSource), submitted topics wait in a pending batch, which goes
+    out when it's full, or when flush() is called because someone needs one
+    of its topics now.  While the queries already in flight are busy, the
+    batches fill up.
+    """
+
+    def __init__(self, newssender: NewsSender, source: NewsSource = None):
+        self.newssender = newssender
+        self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
+        self.source = source if source is not None else NewsSource.from_config(newssender)
+        self.max_in_flight = max(1, newssender.fetch_max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight,
+                                           thread_name_prefix="news-fetch")
+        self.pending_lock = threading.Lock()
+        self.pending: list[tuple[str, Future]] = []
+
+    def get_news(self, topic: str) -> dict:
+        """
+        Get the top news articles for the topic from yesterday, return them as a
+        dict with two n-v pairs - topic name, and a list of relevant articles.
+        If the topic can't be retrieved, the article list is empty and an
+        "error" n-v pair is added
+        :param topic: the topic of interest (str)
+        :return: dict with two n-v pairs - topic name & list of relevant articles
+        """
+        return self.source.fetch_topic(topic)
+
+    def submit(self, topic: str) -> Future:
+        """
+        Start fetching the news for a topic in the background
+        :param topic: the topic of interest
+        :return: Future for the result of get_news()
+        """
+        if self.source.batch_size <= 1:
+            return self.executor.submit(self.get_news, topic)
+        future = Future()
+        with self.pending_lock:
+            self.pending.append((topic, future))
+            batch = self.take_pending() if len(self.pending) >= self.source.batch_size else None
+        if batch is not None:
+            self.executor.submit(self.fetch_batch, batch)
+        return future
+
+    def flush(self, future: Future = None):
+        """
+        Send off the pending batch of topics, if there is one
+        :param future: only if this topic's future is waiting in the batch
+        """
+        with self.pending_lock:
+            if future is not None and all(future is not pending_future
+                                          for _, pending_future in self.pending):
+                return
+            batch = self.take_pending()
+        if batch is not None:
+            self.executor.submit(self.fetch_batch, batch)
+
+    def take_pending(self) -> list:
+        # must hold pending_lock
+        if len(self.pending) == 0:
+            return None
+        batch, self.pending = self.pending, []
+        return batch
+
+    def fetch_batch(self, batch: list[tuple[str, Future]]):
+        try:
+            results = self.source.fetch_topics([topic for topic, _ in batch])
+        except Exception as ex:
+            for _, future in batch:
+                future.set_exception(ex)
+            return
+        for topic, future in batch:
+            future.set_result(results[topic])
+
+    def fetch_topics(self, topics: list) -> dict:
+        """
+        Fetch the news for all the topics in parallel
+        :param topics: list of topics, assumed to be already deduplicated
+        :return: dict of topic -> result of get_news()
+        """
+        futures = [self.submit(topic) for topic in topics]
+        self.flush()
+        return {topic: future.result() for topic, future in zip(topics, futures)}
+
+    def stats(self) -> dict:
+        return self.source.stats()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+        self.source.close()
@@ -0,0 +1,231 @@
+from news_sender import NewsSender
+from subscription import Subscription
+from topic_cache import TopicCache
+from email_renderer import EmailRenderer
+from send_journal import SendJournal
+from concurrent.futures import Future
+import functools
+import threading
+import queue
+import time
+import logging
+
+
+class NewsPipeline:
+    """
+    Runs the subscriptions through three overlapping stages - fetch the news,
+    render the email, send the email - each with its own worker threads, and
+    bounded queues between them.  So the news API round trips and the SMTP
+    sends happen at the same time, and a run takes as long as its slowest
+    stage rather than the sum of all of them.
+
+    The queues are bounded (pipeline_queue_size in the config), so when a
+    stage falls behind the stages feeding it block, all the way back to the
+    loop reading the subscriptions.  Memory use stays flat no matter how many
+    subscriptions there are.
+
+    Each stage's time per subscription, the queue depths and each subscriber's
+    end-to-end time go in the run's metrics.
+
+    With a SendJournal, each subscriber's progress through the stages is
+    journaled, and subscribers in skip_emails (already sent to by the run
+    being resumed) aren't processed again.
+
+    The send stage doesn't wait for each email to go out: it queues the email
+    on the SMTP pool, and the journal entry and stats are done when the send
+    finishes.  So an email held up on a throttled domain (see DomainScheduler)
+    doesn't hold up the emails to other domains behind it.  Up to
+    pipeline_max_sends_in_flight emails are queued at a time.
+
+    With deliver_at, each email is held in the send stage until the
+    subscriber's delivery time, see DeliveryWindow.  The subscriptions should
+    then come in delivery time order, so the bounded queues keep the fetch and
+    render stages just ahead of the sends.
+    """
+
+    def __init__(self, newssender: NewsSender, topic_cache: TopicCache,
+                 renderer: EmailRenderer, journal: SendJournal = None,
+                 skip_emails: set[str] = None, deliver_at=None,
+                 clock=time.time, sleep=time.sleep):
+        """
+        :param deliver_at: function of a subscription record that returns the
+            time (per clock) to send its email at, None to send right away
+        """
+        self.newssender = newssender
+        self.topic_cache = topic_cache
+        self.renderer = renderer
+        self.metrics = newssender.metrics
+        self.journal = journal
+        self.skip_emails = skip_emails if skip_emails is not None else set()
+        self.deliver_at = deliver_at
+        self.clock = clock
+        self.sleep = sleep
+        self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
+        self.fetch_queue: queue.Queue = queue.Queue(maxsize=newssender.pipeline_queue_size)
+        self.render_queue: queue.Queue = queue.Queue(maxsize=newssender.pipeline_queue_size)
+        self.send_queue: queue.Queue = queue.Queue(maxsize=newssender.pipeline_queue_size)
+        self.send_slots = threading.BoundedSemaphore(max(1, newssender.pipeline_max_sends_in_flight))
+        # Futures of the emails queued and not journaled yet
+        self.sends_pending: set[Future] = set()
+        self.stats_lock = threading.Lock()
+        # notified as each email's send_done() finishes
+        self.sends_done = threading.Condition(self.stats_lock)
+        self.stats = {"subscrip_found": 0,
+                      "subscrip_skipped": 0,
+                      "subscrip_proc_ok": 0,
+                      "topics_req": 0,
+                      "topic_proc": 0,
+                      "articles_retr": 0}
+
+    def run(self, subscription_recs) -> dict:
+        """
+        Process all the subscriptions, and wait for the last email to be sent
+        :param subscription_recs: iterable of subscription records, read lazily
+        :return: dict of totals for the run
+        """
+        stages = [(self.fetch_queue, self.fetch_worker, self.newssender.pipeline_fetch_workers),
+                  (self.render_queue, self.render_worker, self.newssender.pipeline_render_workers),
+                  (self.send_queue, self.send_worker, self.newssender.pipeline_send_workers)]
+        stage_threads = []
+        for stage_queue, worker, worker_count in stages:
+            threads = [threading.Thread(target=worker, name=f"{worker.__name__}-{i}", daemon=True)
+                       for i in range(max(1, worker_count))]
+            for thread in threads:
+                thread.start()
+            stage_threads.append((stage_queue, threads))
+        for subscription_rec in subscription_recs:
+            self.stats["subscrip_found"] += 1
+            if subscription_rec.email_address in self.skip_emails:
+                self.stats["subscrip_skipped"] += 1
+                continue
+            # get the topic fetches going as early as possible
+            self.topic_cache.prefetch(Subscription.topics_to_fetch(
+                self.newssender, subscription_rec.topics))
+            # blocks while the pipeline is full
+            self.put(self.fetch_queue, "fetch_queue_depth", (subscription_rec, time.perf_counter()))
+        # shut the stages down in order, each one finishing its queue first
+        for stage_queue, threads in stage_threads:
+            for _ in threads:
+                stage_queue.put(None)
+            for thread in threads:
+                thread.join()
+        self.wait_for_sends()
+        return self.stats
+
+    def put(self, stage_queue: queue.Queue, depth_metric: str, item):
+        self.metrics.observe_depth(depth_metric, stage_queue.qsize())
+        stage_queue.put(item)
+
+    def fetch_worker(self):
+        while (item := self.fetch_queue.get()) is not None:
+            subscription_rec, start_time = item
+            try:
+                with self.metrics.timer("fetch_stage_seconds"):
+                    fetched = Subscription.fetch_subscription(subscription_rec, self.newssender,
+                                                              self.topic_cache)
+            except Exception as ex:
+                self.failed(subscription_rec, "fetch", ex)
+                continue
+            self.journal_state(subscription_rec, SendJournal.STATE_FETCHED)
+            self.put(self.render_queue, "render_queue_depth",
+                     (subscription_rec, start_time, fetched))
+
+    def render_worker(self):
+        while (item := self.render_queue.get()) is not None:
+            subscription_rec, start_time, fetched = item
+            try:
+                with self.metrics.timer("render_stage_seconds"):
+                    email_content = Subscription.render_subscription(
+                        subscription_rec, self.newssender, fetched, self.renderer)
+            except Exception as ex:
+                self.failed(subscription_rec, "render", ex)
+                continue
+            self.journal_state(subscription_rec, SendJournal.STATE_RENDERED)
+            self.put(self.send_queue, "send_queue_depth",
+                     (subscription_rec, start_time, fetched, email_content))
+
+    def send_worker(self):
+        while (item := self.send_queue.get()) is not None:
+            subscription_rec, start_time, fetched, email_content = item
+            if self.deliver_at is not None:
+                self.wait_until(self.deliver_at(subscription_rec))
+            # blocks while pipeline_max_sends_in_flight emails are queued
+            self.send_slots.acquire()
+            send_start = time.perf_counter()
+            try:
+                future = Subscription.submit_subscription(subscription_rec, self.newssender,
+                                                          email_content)
+            except Exception as ex:
+                self.send_slots.release()
+                self.failed(subscription_rec, "send", ex)
+                continue
+            with self.stats_lock:
+                self.sends_pending.add(future)
+            future.add_done_callback(functools.partial(self.send_done, item, send_start))
+
+    def send_done(self, item: tuple, send_start: float, future: Future):
+        """
+        The email's send finished (or was given up on): journal and count it.
+        Runs in the thread that finished the send
+        """
+        subscription_rec, start_time, fetched, _ = item
+        try:
+            stats = Subscription.subscription_sent(subscription_rec, fetched, future.result())
+            self.metrics.observe("send_stage_seconds", time.perf_counter() - send_start)
+            self.metrics.observe("subscriber_seconds", time.perf_counter() - start_time)
+            if not stats["email_sent"]:
+                self.journal_state(subscription_rec, SendJournal.STATE_FAILED)
+            elif self.newssender.spool is not None:
+                self.journal_state(subscription_rec, SendJournal.STATE_SPOOLED)
+            else:
+                self.journal_state(subscription_rec, SendJournal.STATE_SENT)
+            with self.stats_lock:
+                self.stats["subscrip_proc_ok"] += 1 if stats["email_sent"] else 0
+                self.stats["topics_req"] += stats["topics_requested"]
+                self.stats["topic_proc"] += stats["topics_retrieved"]
+                self.stats["articles_retr"] += stats["articles_retrieved"]
+        except Exception as ex:
+            # including the CancelledError of an email given up on
+            self.failed(subscription_rec, "send", ex)
+        finally:
+            with self.sends_done:
+                self.sends_pending.discard(future)
+                self.sends_done.notify_all()
+            self.send_slots.release()
+
+    def wait_for_sends(self):
+        """
+        Wait up to smtp_send_timeout_sec for the emails still queued, and give
+        up on any not sent by then; the ones already being sent can't be given
+        up on, so those are waited for.  Waits for send_done() rather than the
+        Futures, which are done before their callbacks have journaled them
+        """
+        with self.sends_done:
+            self.sends_done.wait_for(lambda: len(self.sends_pending) == 0,
+                                     timeout=self.newssender.smtp_send_timeout_sec)
+            not_done = list(self.sends_pending)
+        if len(not_done) != 0:
+            self.logger.error(f"{len(not_done)} emails not sent after "
+                              f"{self.newssender.smtp_send_timeout_sec} sec, giving up on them")
+        for future in not_done:
+            # a cancelled email's send_done() runs right here
+            future.cancel()
+        with self.sends_done:
+            self.sends_done.wait_for(lambda: len(self.sends_pending) == 0)
+
+    def wait_until(self, send_time: float):
+        delay = send_time - self.clock()
+        if delay > 0:
+            self.metrics.observe("delivery_wait_seconds", delay)
+            self.sleep(delay)
+
+    def journal_state(self, subscription_rec, state: str):
+        if self.journal is not None:
+            self.journal.record_state(subscription_rec.email_address, state)
+
+    def failed(self, subscription_rec, stage: str, ex: Exception):
+        # one bad subscription mustn't take a worker (and so the run) down with it
+        self.metrics.inc(f"{stage}_failures")
+        self.journal_state(subscription_rec, SendJournal.STATE_FAILED)
+        self.logger.error(f"{subscription_rec.email_address}: {stage} failed, "
+                          f"email not sent: {ex}")
@@ -1,8 +1,15 @@
 import json
+import os
 import smtplib
 from email.message import EmailMessage
+from smtp_pool import SmtpPool
+from domain_scheduler import DomainScheduler
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from email_digest import EmailDigest
+from run_metrics import RunMetrics
 from datetime import date, timedelta
 import time
+import threading
 import logging
 from logging.handlers import RotatingFileHandler
 
@@ -23,7 +30,47 @@ class NewsSender:
                             "max_articles_per_topic", "max_topics_per_subscription",
                             "sort_order", "email_timeout_ms",
                             "subscriptions_excel_file", "logfile", "debug"}
+    # optional config params, and the value used when one isn't in the config file
+    OPTIONAL_CONFIG_DEFAULTS: dict = {"news_api_base_url": "https://newsapi.org/v2/everything",
+                                      "fetch_max_in_flight": 4,
+                                      "fetch_requests_per_sec": 1.0,
+                                      "fetch_max_retries": 3,
+                                      "cache_file": "output_files/news_cache.sqlite",
+                                      "cache_ttl_sec": 86400.0,
+                                      "cache_max_entries": 10000,
+                                      "smtp_host": "smtp.gmail.com",
+                                      "smtp_port": 465,
+                                      "smtp_use_ssl": True,
+                                      "smtp_pool_size": 2,
+                                      "smtp_max_msgs_per_conn": 100,
+                                      "smtp_domain_max_rate": 0.0,
+                                      "smtp_domain_max_deferrals": 5,
+                                      "smtp_domain_backoff_sec": 1.0,
+                                      "smtp_send_timeout_sec": 600.0,
+                                      "pipeline_fetch_workers": 4,
+                                      "pipeline_render_workers": 2,
+                                      "pipeline_send_workers": 2,
+                                      "pipeline_queue_size": 100,
+                                      "pipeline_max_sends_in_flight": 500,
+                                      "digest_mode": False,
+                                      "digest_max_buckets": 1000,
+                                      "metrics_json_file": "",
+                                      "metrics_prometheus_file": "",
+                                      "journal_file": "output_files/send_journal.sqlite",
+                                      "journal_batch_size": 100,
+                                      "journal_flush_sec": 2.0,
+                                      "subscriptions_snapshot_file":
+                                          "output_files/subscriptions.snap",
+                                      "daemon_run_time": "06:00",
+                                      "daemon_poll_sec": 60.0,
+                                      "delivery_window_sec": 0.0,
+                                      "news_source": "newsapi",
+                                      "news_source_dir": "",
+                                      "news_batch_size": 1,
+                                      "dedup_backfill_articles": 3,
+                                      "subscription_order": "file"}
     SORT_KEYWORDS = {"relevancy", "popularity", "publishedAt"}
+    SUBSCRIPTION_ORDERS = {"file", "shared_topics"}
     IDX_STATUS = 0
     IDX_ERR_MSG = 2
     IDX_SUBJECTS_FOUND = 3
@@ -34,10 +81,26 @@ class NewsSender:
     # TODO: Would be nice to refactor to have a NewsFeedConfig class.  However,
     #  would have to work at not exposing password in memory
 
-    def __init__(self):
+    def __init__(self, config_filename: str = CONFIG_FILENAME, connect: bool = True):
+        """
+        :param config_filename: the config file to load
+        :param connect: False to just load the config, without connecting to
+            the email server
+        """
         # Load in the config from the JSON format config file
         # Not putting this stuff here is a style violation (PEP? or just PyCharm?)
-        self.sender_account_connection: smtplib.SMTP_SSL = smtplib.SMTP_SSL()
+        self.config_filename = config_filename
+        self.connect = connect
+        self.logfile: str = ""
+        self.logger: logging.Logger = logging.getLogger(NewsSender.LOGGER_NAME)
+        # metrics for the run, shared by everything that has the NewsSender
+        self.metrics = RunMetrics()
+        self.smtp_pool: SmtpPool = None
+        # a mail_spool.SpoolWriter in spool mode: emails are written to it, not sent
+        self.spool = None
+        # in debug mode, the first email of the run is written out to look at
+        self.debug_sample_lock = threading.Lock()
+        self.debug_sample_taken = False
         self.sender_account: str = ""
         self.news_api_key: str = ""
         self.max_articles_per_topic: int = 0
@@ -46,12 +109,67 @@ class NewsSender:
         self.debug:bool = True
         self.sort_order: str = ""
         self.subscriptions_excel_file = ""
+        self.news_api_base_url: str = ""
+        self.fetch_max_in_flight: int = 0
+        self.fetch_requests_per_sec: float = 0.0
+        self.fetch_max_retries: int = 0
+        self.cache_file: str = ""
+        self.cache_ttl_sec: float = 0.0
+        self.cache_max_entries: int = 0
+        self.smtp_host: str = ""
+        self.smtp_port: int = 0
+        self.smtp_use_ssl: bool = True
+        self.smtp_pool_size: int = 0
+        self.smtp_max_msgs_per_conn: int = 0
+        self.smtp_domain_max_rate: float = 0.0
+        self.smtp_domain_max_deferrals: int = 0
+        self.smtp_domain_backoff_sec: float = 0.0
+        self.smtp_send_timeout_sec: float = 0.0
+        self.pipeline_fetch_workers: int = 0
+        self.pipeline_render_workers: int = 0
+        self.pipeline_send_workers: int = 0
+        self.pipeline_queue_size: int = 0
+        self.pipeline_max_sends_in_flight: int = 0
+        self.digest_mode: bool = False
+        self.digest_max_buckets: int = 0
+        self.digest: EmailDigest = None
+        self.metrics_json_file: str = ""
+        self.metrics_prometheus_file: str = ""
+        self.journal_file: str = ""
+        self.journal_batch_size: int = 0
+        self.journal_flush_sec: float = 0.0
+        self.subscriptions_snapshot_file: str = ""
+        self.daemon_run_time: str = ""
+        self.daemon_poll_sec: float = 0.0
+        self.delivery_window_sec: float = 0.0
+        self.news_source: str = ""
+        self.news_source_dir: str = ""
+        self.news_batch_size: int = 0
+        self.dedup_backfill_articles: int = 0
+        self.subscription_order: str = ""
         self.config: dict = self.load_config_and_connect()
-        self.logfile: str = ""
-        self.logger: logging.Logger = None
+        self.date_str = NewsSender.news_date_str(date.today())
+
+    @staticmethod
+    def news_date_str(today: date) -> str:
         # for news searches.  free use of API only works for news 1 day old or older
-        yesterday = date.today() - timedelta(days=1)
-        self.date_str = yesterday.strftime("%Y-%m-%d")
+        yesterday = today - timedelta(days=1)
+        return yesterday.strftime("%Y-%m-%d")
+
+    def start_run(self, today: date):
+        """
+        Reset the per-run state, for a long-running process (see NewsDaemon)
+        that does a run a day with the same NewsSender and email connections
+        :param today: the day of the run
+        """
+        self.date_str = NewsSender.news_date_str(today)
+        self.metrics = RunMetrics()
+        self.debug_sample_taken = False
+        if self.smtp_pool is not None:
+            self.smtp_pool.metrics = self.metrics
+        if self.digest is not None:
+            # yesterday's encoded bodies are no good for today's news
+            self.digest = EmailDigest(self.sender_account, self.digest_max_buckets)
 
     def load_config_and_connect(self) -> dict:
         """
@@ -63,7 +181,7 @@ class NewsSender:
         :return: dictionary with the loaded config
         """
         try:
-            file = open(NewsSender.CONFIG_FILENAME, "r")
+            file = open(self.config_filename, "r")
             config_data = json.load(file)
         except Exception as ex:
             # since don't have config info (and log file name/path) yet
@@ -76,7 +194,10 @@ class NewsSender:
             self.start_logging(self.logfile)
         self.logger.info(">>>>>> Starting up EmailNewsFeed app")
         sender_pwd = self.check_config_params(config_data, config_keys_found)
-        self.sender_account_connection = self.connect_sender(sender_pwd)
+        if self.connect:
+            self.smtp_pool = self.connect_sender(sender_pwd)
+        if self.digest_mode:
+            self.digest = EmailDigest(self.sender_account, self.digest_max_buckets)
         return config_data
 
     def check_config_params(self, config_data, config_keys_found) -> str:
@@ -94,7 +215,8 @@ class NewsSender:
         extra_keys = []
         # doing this early so can use logging from now on
         for key in config_keys_found:
-            if key not in config_keys_needed and key != "_comment_":
+            if key not in config_keys_needed and key != "_comment_" \
+                    and key not in NewsSender.OPTIONAL_CONFIG_DEFAULTS:
                 extra_keys.append(key)
         for key in config_keys_needed:
             if key not in config_keys_found:
@@ -110,7 +232,6 @@ class NewsSender:
         self.news_api_key = config_data["news_api_key"]
         self.max_articles_per_topic = config_data["max_articles_per_topic"]
         self.max_topics_per_subscription = config_data["max_topics_per_subscription"]
-        # TODO: use the timeout in the smtp API calls
         self.email_timeout_sec: float = config_data["email_timeout_ms"] / 1000.0
         self.debug = config_data["debug"].strip().upper() == "TRUE"
         if self.debug:
@@ -121,8 +242,32 @@ class NewsSender:
             self.logger.error(f"Error in config: sort_order not a valid value:"
                               f" {self.sort_order}, will assume 'relevancy'")
             self.sort_order = "relevancy"
+        self.check_optional_config_params(config_data)
+        if self.subscription_order not in NewsSender.SUBSCRIPTION_ORDERS:
+            self.logger.error(f"Error in config: subscription_order not a valid value:"
+                              f" {self.subscription_order}, will assume 'file'")
+            self.subscription_order = "file"
         return sender_pwd
 
+    def check_optional_config_params(self, config_data):
+        """
+        Set the optional config params, using the default for any not in the
+        config file, or with the wrong type of value
+        :param config_data: Dict with the JSON data from the config file
+        """
+        for key, default in NewsSender.OPTIONAL_CONFIG_DEFAULTS.items():
+            value = config_data.get(key, default)
+            try:
+                if isinstance(default, bool) and isinstance(value, str):
+                    # same "true"/"false" string convention as the debug param
+                    value = value.strip().upper() == "TRUE"
+                value = type(default)(value)
+            except (TypeError, ValueError):
+                self.logger.error(f"Error in config: {key} not a valid value:"
+                                  f" {value}, will assume {default}")
+                value = default
+            setattr(self, key, value)
+
     def start_logging(self, logfilename: str):
         # check file appendable first
         try:
@@ -135,17 +280,25 @@ class NewsSender:
             exit(1)
         self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
         self.logger.setLevel(logging.INFO)
+        logfile_path = os.path.abspath(logfilename)
+        if any(getattr(handler, "baseFilename", None) == logfile_path
+               for handler in self.logger.handlers):
+            # already logging there, e.g. from an earlier NewsSender in this process
+            return
         handler = RotatingFileHandler(filename=logfilename, mode="a",
                                       maxBytes=500000, backupCount=4)
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s')
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
 
-    def connect_sender(self, pwd: str) -> smtplib.SMTP_SSL:
+    def connect_sender(self, pwd: str) -> SmtpPool:
         """
-        Connect sender to gmail SMTP server
+        Connect sender to the (gmail by default) SMTP server, with a pool of
+        smtp_pool_size connections that the emails are sent through.  The
+        password is only kept by the pool's connect function, which needs it
+        to log back in when the server drops a connection
         :param pwd: password for email account
-        :return: smtp_ssl connection to gmail
+        :return: the connection pool
         """
         # TODO look into refactoring to use OAUTH 2.0 - not now, that will
         #   take a fair amount of research
@@ -153,43 +306,129 @@ class NewsSender:
         # using the smptlib to deal with it directory.
         # TODO: Look into which API yagmail uses - he didn't set up a google dev
         #  account and get an API key, probably smtplib.
-        smtp_server: smtplib.SMTP_SSL = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+        def connect() -> smtplib.SMTP:
+            smtp_class = smtplib.SMTP_SSL if self.smtp_use_ssl else smtplib.SMTP
+            smtp_server: smtplib.SMTP = smtp_class(self.smtp_host, self.smtp_port,
+                                                   timeout=self.email_timeout_sec)
+            if pwd != "":
+                connect_resp = smtp_server.login(user=self.sender_account, password=pwd)
+                self.logger.info(f"connected, value returned: {connect_resp}")
+            return smtp_server
+
         try:
-            connect_resp = smtp_server.login(user=self.sender_account, password=pwd)
-            self.logger.info(f"connected, value returned: {connect_resp}")
-        except smtplib.SMTPException as smtpe:
+            scheduler = DomainScheduler(self.smtp_domain_max_rate, self.smtp_domain_max_deferrals,
+                                        self.smtp_domain_backoff_sec)
+            return SmtpPool(connect, self.smtp_pool_size, self.smtp_max_msgs_per_conn,
+                            logger_name=NewsSender.LOGGER_NAME, metrics=self.metrics,
+                            scheduler=scheduler)
+        except (smtplib.SMTPException, OSError) as smtpe:
             self.logger.critical(f"Exception trying to login to email:"
                                  f" {smtpe}, will exit")
-        return smtp_server
+            exit(1)
+
+    def build_html_email(self, subject: str, html_body: str, recipients: list[str]) -> EmailMessage:
+        msg = EmailMessage()
+        msg['Subject'] = subject
+        msg['From'] = self.sender_account
+        msg['To'] = ", ".join(recipients)
+        msg.set_content(html_body, subtype='html')
+        return msg
 
     def send_html_email(self, subject: str, html_body:str, recipients: list[str]) -> (bool, str):
         """
-        send an HTML-format email message using the established
-        email connection
+        send an HTML-format email message through the connection pool, and
+        wait for it to be sent
         :param subject: subject line
         :param html_body: the body of the email
         :param recipients: a list of recipients.  Even one recipient must
            still be in a list
         :return: list with bool sent successfully, ena status resp or error msg
         """
-        msg = EmailMessage()
-        msg['Subject'] = subject
-        msg['From'] = self.sender_account
-        msg['To'] = ", ".join(recipients)
-        msg.set_content(html_body, subtype='html')
-        # print(recipients)
-        # print("msg: ", msg)
-        # print("msg.as_string()", msg.as_string())
+        return self.wait_for_send(self.submit_html_email(subject, html_body, recipients))
+
+    def submit_html_email(self, subject: str, html_body: str, recipients: list[str]) -> Future:
+        """
+        send_html_email() without the wait
+        :return: Future for the (bool sent successfully, status resp or error msg) tuple
+        """
+        return self.submit(self.build_html_email(subject, html_body, recipients))
+
+    def send_digest_email(self, subject: str, personal_html: str, bucket_key,
+                          shared_html: str, recipients: list[str]) -> (bool, str):
+        """
+        digest mode version of send_html_email(): the body is in two parts, and
+        the shared part is only encoded once for all the subscribers in the
+        same bucket, see EmailDigest
+        :param subject: subject line
+        :param personal_html: start of the body, through the personalized greeting
+        :param bucket_key: the subscriber's effective topic list
+        :param shared_html: rest of the body, the same for the whole bucket
+        :param recipients: a list of recipients
+        :return: list with bool sent successfully, ena status resp or error msg
+        """
+        return self.wait_for_send(self.submit_digest_email(subject, personal_html, bucket_key,
+                                                           shared_html, recipients))
+
+    def submit_digest_email(self, subject: str, personal_html: str, bucket_key,
+                            shared_html: str, recipients: list[str]) -> Future:
+        """
+        send_digest_email() without the wait
+        :return: Future for the (bool sent successfully, status resp or error msg) tuple
+        """
+        return self.submit(self.digest.build_message(subject, personal_html, bucket_key,
+                                                     shared_html, recipients))
+
+    def submit(self, msg) -> Future:
+        """
+        queue a built email on the connection pool, or in spool mode, write it
+        to the spool
+        :param msg: the EmailMessage or RawEmail
+        :return: Future for the (bool sent successfully, status resp or error msg) tuple
+        """
+        if self.spool is not None:
+            future = Future()
+            future.set_result(self.spool.write(msg))
+            return future
+        return self.smtp_pool.submit(msg)
+
+    def wait_for_send(self, future: Future) -> (bool, str):
+        """
+        wait up to smtp_send_timeout_sec for a submitted email; one that's
+        still queued then (e.g. on a throttled domain) is given up on, but one
+        that's being sent is waited for, so it's never reported as not sent
+        when it was
+        :return: list with bool sent successfully, ena status resp or error msg
+        """
         try:
-            send_resp = self.sender_account_connection.send_message(msg)
-        except smtplib.SMTPException as smtpe:
-            self.logger.error(f"Got exception sending email: {smtpe}")
-            return False, smtpe
-        # print(f"Message subject {subject} sent!")
-        return True, "no error"
+            return future.result(timeout=self.smtp_send_timeout_sec)
+        except FutureTimeoutError:
+            if not future.cancel():
+                # already being sent (or deferred after a try), wait for how it went
+                return future.result()
+            return False, f"not sent after {self.smtp_send_timeout_sec} sec, given up"
+
+    def deliver(self, msg) -> (bool, str):
+        """
+        send a built email and wait for it, see submit()
+        :return: list with bool sent successfully, ena status resp or error msg
+        """
+        return self.wait_for_send(self.submit(msg))
+
+    def take_debug_sample(self) -> bool:
+        """
+        :return: True for the first caller of the run, which gets to write out
+            its email in debug mode
+        """
+        with self.debug_sample_lock:
+            taken = self.debug_sample_taken
+            self.debug_sample_taken = True
+        return not taken
 
     def close_connection(self):
-        self.sender_account_connection.quit()
+        if self.smtp_pool is not None:
+            self.smtp_pool.close()
+        if self.spool is not None:
+            self.spool.close()
 
 
 if __name__ == '__main__':
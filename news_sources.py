@@ -0,0 +1,571 @@
+from news_sender import NewsSender
+from article_cache import ArticleCache
+from email.utils import parsedate_to_datetime
+import functools
+import threading
+import time
+import json
+import logging
+import os
+import re
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter, shared by all the fetch threads so that the
+    news API sees no more than `rate` requests per second on average, with
+    bursts of up to `capacity` requests.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last_refill = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, then take it.  A rate of 0 or less
+        means no rate limit.
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait_sec = (1.0 - self.tokens) / self.rate
+            self.sleep(wait_sec)
+
+
+class NewsSourceError(Exception):
+    """
+    A news source couldn't answer a query
+    """
+
+
+class NewsSource:
+    """
+    Where the news comes from.  A source answers searches for articles
+    about any of a list of topics; fetch_topic()/fetch_topics() turn that into
+    the per-topic news dicts the rest of the app uses: the topic, and its list
+    of articles (plus an "error" n-v pair if the topic couldn't be retrieved).
+
+    Articles are dicts in the newsapi.org format, with at least "title",
+    "description" and "url".
+
+    The news_source config param picks the source, see from_config(); with a
+    news_batch_size over 1 it's wrapped in a BatchingNewsSource.
+    """
+
+    # topics per fetch_topics() call that the source would like, see NewsFetcher
+    batch_size = 1
+    # most topics a single search() can take
+    MAX_BATCH_SIZE = 1
+    # most articles a single search() can return, None for no limit
+    MAX_PAGE_SIZE = None
+
+    def __init__(self, newssender: NewsSender):
+        self.newssender = newssender
+        self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
+        self.stats_lock = threading.Lock()
+        self.failures = 0
+
+    @classmethod
+    def from_config(cls, newssender: NewsSender) -> "NewsSource":
+        """
+        :return: the news source configured for the run
+        """
+        if newssender.news_source == "local":
+            source = LocalDirectorySource(newssender, newssender.news_source_dir)
+        elif newssender.news_source == "fake":
+            source = FakeNewsSource(newssender)
+        else:
+            source = NewsApiSource(newssender)
+        if newssender.news_batch_size > 1:
+            source = BatchingNewsSource(source, newssender.news_batch_size)
+        return source
+
+    def search(self, topics: list[str], page_size: int) -> list[dict]:
+        """
+        :param topics: topics to search for, articles about any of them will do
+        :param page_size: most articles to return
+        :return: the articles found, best first
+        :raise NewsSourceError: if the source couldn't be searched
+        """
+        raise NotImplementedError
+
+    def fits(self, topics: list[str]) -> bool:
+        """
+        :return: True if the topics can all go in a single search()
+        """
+        return len(topics) <= 1
+
+    def fetch_topic(self, topic: str) -> dict:
+        """
+        Get the top news articles for the topic from yesterday
+        :param topic: the topic of interest
+        :return: dict with two n-v pairs - topic name & list of relevant
+            articles, and an "error" n-v pair if they couldn't be retrieved
+        """
+        try:
+            articles = self.search([topic], self.articles_per_topic())
+        except NewsSourceError as ex:
+            return self.failed(topic, str(ex))
+        return {"topic": f"{topic}", "articles": articles}
+
+    def articles_per_topic(self) -> int:
+        """
+        :return: how many articles to get for each topic: max_articles_per_topic,
+            plus spares to fill in for duplicates, see ArticleIndex
+        """
+        return self.newssender.max_articles_per_topic + self.newssender.dedup_backfill_articles
+
+    def fetch_topics(self, topics: list[str]) -> dict:
+        """
+        :return: dict of topic -> result of fetch_topic()
+        """
+        return {topic: self.fetch_topic(topic) for topic in topics}
+
+    def failed(self, topic: str, error_msg: str) -> dict:
+        with self.stats_lock:
+            self.failures += 1
+        self.logger.error(f"Could not retrieve news for topic \"{topic}\": {error_msg}")
+        return {"topic": f"{topic}", "articles": [], "error": error_msg}
+
+    @staticmethod
+    def normalize_text(text) -> str:
+        return " ".join(str(text or "").split()).casefold()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def topic_pattern(topic: str) -> re.Pattern:
+        """
+        :return: regex for the topic as a whole word or phrase, so "AI" doesn't
+            match "said"; word characters on either side rule it out, rather than
+            word boundaries, which a topic like "C++" doesn't end on
+        """
+        return re.compile(rf"(?<!\w){re.escape(NewsSource.normalize_text(topic))}(?!\w)")
+
+    @staticmethod
+    def matches(topic: str, article: dict) -> bool:
+        """
+        :return: True if the topic shows up in the article's title or
+            description, as whole words
+        """
+        return NewsSource.topic_pattern(topic).search(NewsSource.normalize_text(
+            f"{article.get('title') or ''} {article.get('description') or ''}")) is not None
+
+    def stats(self) -> dict:
+        return {"api_failures": self.failures}
+
+    def close(self):
+        pass
+
+
+class NewsApiSource(NewsSource):
+    """
+    The newsapi.org /v2/everything API (or whatever news_api_base_url points
+    to).  Requests are throttled by a token bucket to fetch_requests_per_sec,
+    and retried with exponential backoff when the server answers 429 or 5xx,
+    or the request fails outright.  All the requests share one HTTP session,
+    so connections are reused.
+
+    Responses are kept in the persistent ArticleCache (unless cache_file is
+    configured as ""), so reruns on the same news day don't hit the API.
+    """
+
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+    REQUEST_TIMEOUT_SEC = 10
+    BACKOFF_BASE_SEC = 1.0
+    BACKOFF_MAX_SEC = 30.0
+    # newsapi.org limit on the q param
+    MAX_QUERY_LENGTH = 500
+    MAX_PAGE_SIZE = 100
+    MAX_BATCH_SIZE = 20
+
+    def __init__(self, newssender: NewsSender):
+        super().__init__(newssender)
+        # requests is slow to import, and only needed once there's news to fetch
+        import requests
+        self.session = requests.Session()
+        self.rate_limiter = TokenBucket(newssender.fetch_requests_per_sec)
+        self.sleep = time.sleep
+        self.requests_sent = 0
+        self.retries = 0
+        self.cache: ArticleCache = None
+        if newssender.cache_file != "":
+            self.cache = ArticleCache(newssender.cache_file, newssender.cache_ttl_sec,
+                                      newssender.cache_max_entries)
+
+    @staticmethod
+    def query_string(topics: list[str]) -> str:
+        if len(topics) == 1:
+            return topics[0]
+        return " OR ".join(f'"{topic}"' for topic in topics)
+
+    def fits(self, topics: list[str]) -> bool:
+        return len(NewsApiSource.query_string(topics)) <= NewsApiSource.MAX_QUERY_LENGTH
+
+    def query_params(self, topics: list[str], page_size: int) -> dict:
+        # news.org free license only permits news that's >= 24 hours old
+        return {"q": NewsApiSource.query_string(topics),
+                "from": self.newssender.date_str,
+                "language": "en",
+                # a combined query is split up by title and description afterwards
+                "searchin": "description" if len(topics) == 1 else "title,description",
+                "sortBy": self.newssender.sort_order,
+                "pageSize": min(page_size, NewsApiSource.MAX_PAGE_SIZE),
+                "apiKey": self.newssender.news_api_key}
+
+    def search(self, topics: list[str], page_size: int) -> list[dict]:
+        import requests
+        query_params = self.query_params(topics, page_size)
+        cache_key = None
+        revalidate_headers = None
+        if self.cache is not None:
+            # the API key isn't part of what the answer depends on
+            cache_key = ArticleCache.make_key(
+                {"url": self.newssender.news_api_base_url} |
+                {k: v for k, v in query_params.items() if k != "apiKey"})
+            cached, revalidate_headers = self.cache.get(cache_key)
+            if cached is not None:
+                return cached["articles"]
+        error_msg = ""
+        for attempt in range(self.newssender.fetch_max_retries + 1):
+            if attempt > 0:
+                with self.stats_lock:
+                    self.retries += 1
+            retry_after = None
+            try:
+                response = self.request(query_params, revalidate_headers)
+                if response.status_code == 304 and cache_key is not None:
+                    cached = self.cache.revalidated(cache_key)
+                    if cached is not None:
+                        return cached["articles"]
+                    # evicted since it was looked up: nothing to revalidate, get it afresh
+                    self.logger.debug(f"Cached response for \"{query_params['q']}\" evicted "
+                                      f"before it was revalidated, fetching it again")
+                    revalidate_headers = None
+                    response = self.request(query_params, revalidate_headers)
+                if response.status_code in NewsApiSource.RETRY_STATUS_CODES:
+                    error_msg = f"status {response.status_code}"
+                    retry_after = response.headers.get("Retry-After")
+                else:
+                    response.raise_for_status()
+                    articles = response.json()
+                    self.logger.debug(f"Request for \"{query_params['q']}\":\nstatus: "
+                                      f"{response.status_code}, total articles found: "
+                                      f"{articles['totalResults']}\narticles retrieved: "
+                                      f"{len(articles['articles'])}")
+                    if cache_key is not None:
+                        self.cache.put(cache_key, articles, response.headers.get("ETag"),
+                                       response.headers.get("Last-Modified"))
+                    return articles["articles"]
+            except requests.HTTPError as ex:
+                # 4xx other than 429 won't get better by asking again
+                error_msg = str(ex)
+                break
+            except (requests.RequestException, ValueError, KeyError) as ex:
+                error_msg = str(ex)
+            if attempt < self.newssender.fetch_max_retries:
+                self.sleep(self.backoff_sec(attempt, retry_after))
+        raise NewsSourceError(error_msg)
+
+    def request(self, query_params: dict, headers: dict):
+        """
+        One throttled request to the API
+        :param headers: extra request headers, e.g. conditional ones, or None
+        :return: the requests Response
+        """
+        self.rate_limiter.acquire()
+        with self.stats_lock:
+            self.requests_sent += 1
+        with self.newssender.metrics.timer("newsapi_request_seconds"):
+            return self.session.get(url=self.newssender.news_api_base_url,
+                                    params=query_params, headers=headers,
+                                    timeout=NewsApiSource.REQUEST_TIMEOUT_SEC)
+
+    @classmethod
+    def backoff_sec(cls, attempt: int, retry_after: str = None) -> float:
+        """
+        How long to wait before retry number attempt + 1.  Honors the server's
+        Retry-After header (in seconds) if it sent one
+        """
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), cls.BACKOFF_MAX_SEC)
+            except ValueError:
+                pass
+        return min(cls.BACKOFF_BASE_SEC * (2 ** attempt), cls.BACKOFF_MAX_SEC)
+
+    def stats(self) -> dict:
+        stats = {"api_requests": self.requests_sent,
+                 "api_retries": self.retries,
+                 "api_failures": self.failures}
+        if self.cache is not None:
+            stats.update(self.cache.stats())
+        return stats
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+class LocalDirectorySource(NewsSource):
+    """
+    Articles from the files in a local directory (news_source_dir), e.g.
+    dropped there by a feed reader or a scraper:
+        - .json: a newsapi.org style response, or a list of articles
+        - .rss/.xml/.atom: an RSS 2.0 or Atom feed
+    A topic's articles are the ones with the topic in the title or
+    description, published on or after the news date if they say when they
+    were published.  The files are read again when any of them change.
+    """
+
+    JSON_EXTENSIONS = {".json"}
+    FEED_EXTENSIONS = {".rss", ".xml", ".atom"}
+    ATOM = "{http://www.w3.org/2005/Atom}"
+    MAX_BATCH_SIZE = 1000
+
+    def __init__(self, newssender: NewsSender, directory: str):
+        super().__init__(newssender)
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.signature: tuple = None
+        self.articles: list[dict] = []
+        self.searches = 0
+
+    def fits(self, topics: list[str]) -> bool:
+        return True
+
+    def load(self) -> list[dict]:
+        """
+        :return: all the articles in the directory, reading the files again
+            if they've changed since last time
+        """
+        try:
+            entries = sorted((entry for entry in os.scandir(self.directory) if entry.is_file()),
+                             key=lambda entry: entry.name)
+        except OSError as ex:
+            raise NewsSourceError(f"can't read news directory {self.directory}: {ex}")
+        signature = tuple((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                          for entry in entries)
+        from xml.etree import ElementTree
+        with self.lock:
+            if signature == self.signature:
+                return self.articles
+            articles = []
+            for entry in entries:
+                extension = os.path.splitext(entry.name)[1].lower()
+                try:
+                    if extension in LocalDirectorySource.JSON_EXTENSIONS:
+                        articles.extend(self.read_json(entry.path))
+                    elif extension in LocalDirectorySource.FEED_EXTENSIONS:
+                        articles.extend(self.read_feed(entry.path))
+                except (OSError, ValueError, ElementTree.ParseError) as ex:
+                    self.logger.error(f"Skipping unreadable news file {entry.path}: {ex}")
+            self.logger.info(f"Read {len(articles)} articles from {len(entries)} files "
+                             f"in {self.directory}")
+            self.signature = signature
+            self.articles = articles
+            return articles
+
+    @staticmethod
+    def read_json(filename: str) -> list[dict]:
+        with open(filename, "r", encoding="utf-8") as file:
+            data = json.load(file)
+        return data["articles"] if isinstance(data, dict) else data
+
+    @classmethod
+    def read_feed(cls, filename: str) -> list[dict]:
+        from xml.etree import ElementTree
+        root = ElementTree.parse(filename).getroot()
+        articles = []
+        for item in root.iter("item"):
+            articles.append({"source": {"name": root.findtext("channel/title")},
+                             "title": item.findtext("title"),
+                             "description": item.findtext("description"),
+                             "url": item.findtext("link"),
+                             "publishedAt": cls.iso_date(item.findtext("pubDate"))})
+        for entry in root.iter(f"{cls.ATOM}entry"):
+            link = entry.find(f"{cls.ATOM}link")
+            articles.append({"source": {"name": root.findtext(f"{cls.ATOM}title")},
+                             "title": entry.findtext(f"{cls.ATOM}title"),
+                             "description": entry.findtext(f"{cls.ATOM}summary"),
+                             "url": link.get("href") if link is not None else None,
+                             "publishedAt": entry.findtext(f"{cls.ATOM}updated")})
+        return articles
+
+    @staticmethod
+    def iso_date(rfc822_date: str) -> str:
+        if rfc822_date is None:
+            return None
+        try:
+            return parsedate_to_datetime(rfc822_date).isoformat()
+        except (TypeError, ValueError):
+            return None
+
+    def search(self, topics: list[str], page_size: int) -> list[dict]:
+        with self.stats_lock:
+            self.searches += 1
+        date_str = self.newssender.date_str
+        found = [article for article in self.load()
+                 if (article.get("publishedAt") or date_str)[:10] >= date_str
+                 and any(NewsSource.matches(topic, article) for topic in topics)]
+        if self.newssender.sort_order == "publishedAt":
+            found.sort(key=lambda article: article.get("publishedAt") or "", reverse=True)
+        return found[:page_size]
+
+    def stats(self) -> dict:
+        return {"local_searches": self.searches,
+                "api_failures": self.failures}
+
+
+class FakeNewsSource(NewsSource):
+    """
+    Made-up articles for any topic, for tests and benchmarks: no network, and
+    the same articles for the same topic every time.  Each article has its
+    topic in the title.  Counts the searches, as a real source would count
+    requests.
+    """
+
+    MAX_BATCH_SIZE = 20
+    # the same limit as newsapi.org, so batching is held to it
+    MAX_PAGE_SIZE = 100
+
+    def __init__(self, newssender: NewsSender, articles_per_topic: int = None,
+                 latency_sec: float = 0.0):
+        """
+        :param latency_sec: how long each search takes, as if over the network
+        """
+        super().__init__(newssender)
+        self.latency_sec = latency_sec
+        self.article_count = articles_per_topic if articles_per_topic is not None \
+            else self.articles_per_topic()
+        self.searches = 0
+        self.topics_searched = 0
+
+    def fits(self, topics: list[str]) -> bool:
+        return True
+
+    def topic_articles(self, topic: str) -> list[dict]:
+        slug = "-".join(NewsSource.normalize_text(topic).split())
+        return [{"source": {"name": "Fake News"},
+                 "title": f"{topic} story number {i}",
+                 "description": f"All about {topic}, part {i} of {self.article_count}.",
+                 "url": f"https://fake.example.com/{slug}/{i}",
+                 "publishedAt": f"{self.newssender.date_str}T00:00:00Z"}
+                for i in range(self.article_count)]
+
+    def search(self, topics: list[str], page_size: int) -> list[dict]:
+        with self.stats_lock:
+            self.searches += 1
+            self.topics_searched += len(topics)
+        if self.latency_sec > 0:
+            time.sleep(self.latency_sec)
+        per_topic = [self.topic_articles(topic) for topic in topics]
+        # interleaved, as a relevance-sorted search for several topics might be
+        found = [article for rank in zip(*per_topic) for article in rank]
+        return found[:min(page_size, FakeNewsSource.MAX_PAGE_SIZE)]
+
+    def stats(self) -> dict:
+        return {"fake_searches": self.searches,
+                "fake_topics_searched": self.topics_searched,
+                "api_failures": self.failures}
+
+
+class BatchingNewsSource(NewsSource):
+    """
+    Cuts the number of requests by combining up to news_batch_size topics
+    into one search (an OR query, for newsapi.org), then sorting the articles
+    out to their topics by matching the topic against each article's title
+    and description.  Each topic keeps at most articles_per_topic() of them.
+
+    The search asks for enough articles to fill every topic in the batch, so
+    a batch is no bigger than fits in the source's page size limit.  If the
+    page came back full and some topic got fewer than its share of the
+    articles, the other topics may have crowded it out, so that topic is
+    searched for on its own.
+    """
+
+    def __init__(self, source: NewsSource, batch_size: int):
+        super().__init__(source.newssender)
+        self.source = source
+        batch_size = min(batch_size, source.MAX_BATCH_SIZE)
+        if source.MAX_PAGE_SIZE is not None:
+            batch_size = min(batch_size, source.MAX_PAGE_SIZE // self.articles_per_topic())
+        self.batch_size = max(1, batch_size)
+        self.batches = 0
+        self.topics_batched = 0
+        self.fallbacks = 0
+
+    def batches_of(self, topics: list[str]) -> list[list[str]]:
+        batches = []
+        batch = []
+        for topic in topics:
+            if len(batch) != 0 and (len(batch) >= self.batch_size
+                                    or not self.source.fits(batch + [topic])):
+                batches.append(batch)
+                batch = []
+            batch.append(topic)
+        if len(batch) != 0:
+            batches.append(batch)
+        return batches
+
+    def fetch_topic(self, topic: str) -> dict:
+        return self.fetch_topics([topic])[topic]
+
+    def fetch_topics(self, topics: list[str]) -> dict:
+        results = {}
+        for batch in self.batches_of(topics):
+            results.update(self.fetch_batch(batch))
+        return results
+
+    def fetch_batch(self, topics: list[str]) -> dict:
+        if len(topics) == 1:
+            return {topics[0]: self.source.fetch_topic(topics[0])}
+        max_articles = self.articles_per_topic()
+        page_size = max_articles * len(topics)
+        with self.stats_lock:
+            self.batches += 1
+            self.topics_batched += len(topics)
+        try:
+            articles = self.source.search(topics, page_size)
+        except NewsSourceError as ex:
+            return {topic: self.failed(topic, str(ex)) for topic in topics}
+        results = {topic: {"topic": f"{topic}", "articles": []} for topic in topics}
+        for article in articles:
+            for topic in topics:
+                topic_articles = results[topic]["articles"]
+                if len(topic_articles) < max_articles and NewsSource.matches(topic, article):
+                    topic_articles.append(article)
+        # the batch size keeps page_size within the source's limit
+        page_full = len(articles) >= page_size
+        for topic in topics:
+            if page_full and len(results[topic]["articles"]) < max_articles:
+                with self.stats_lock:
+                    self.fallbacks += 1
+                results[topic] = self.source.fetch_topic(topic)
+        return results
+
+    def stats(self) -> dict:
+        stats = self.source.stats()
+        stats["api_failures"] = stats.get("api_failures", 0) + self.failures
+        stats.update({"batch_queries": self.batches,
+                      "batch_topics": self.topics_batched,
+                      "batch_fallbacks": self.fallbacks})
+        return stats
+
+    def close(self):
+        self.source.close()
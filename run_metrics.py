@@ -0,0 +1,144 @@
+from contextlib import contextmanager
+import threading
+import time
+import json
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, Prometheus style: each bucket counts the
+    observations less than or equal to its upper bound.
+    """
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    DEPTH_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        """
+        :return: estimate of the q quantile - the upper bound of the bucket it falls in
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {"count": self.count,
+                "sum": round(self.sum, 6),
+                "mean": round(self.sum / self.count, 6) if self.count != 0 else 0.0,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.quantile(0.5),
+                "p95": self.quantile(0.95),
+                "p99": self.quantile(0.99),
+                "buckets": dict(zip([str(bound) for bound in self.buckets], self.bucket_counts))}
+
+
+class RunMetrics:
+    """
+    Metrics for one run of the app: latency histograms for the news API
+    requests, SMTP sends, the pipeline stages and each subscriber end to end,
+    queue depth histograms, and counters.  Shared by all the threads in the
+    run, via the NewsSender.
+
+    At the end of the run, the metrics and the run's final stats are written
+    as a JSON summary, and optionally in Prometheus text format (e.g. for the
+    node_exporter textfile collector).
+    """
+
+    PROMETHEUS_PREFIX = "newsfeed_"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: dict[str, Histogram] = {}
+        self.counters: dict[str, int] = {}
+        self.start_time = time.time()
+
+    def observe(self, name: str, value: float, buckets: tuple = Histogram.LATENCY_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def observe_depth(self, name: str, depth: int):
+        self.observe(name, depth, Histogram.DEPTH_BUCKETS)
+
+    def inc(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        Time the with block, in seconds, into the named histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def to_dict(self, run_stats: dict = None) -> dict:
+        with self.lock:
+            return {"run_start": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                               time.localtime(self.start_time)),
+                    "run_seconds": round(time.time() - self.start_time, 3),
+                    "stats": run_stats if run_stats is not None else {},
+                    "counters": dict(self.counters),
+                    "histograms": {name: histogram.to_dict()
+                                   for name, histogram in self.histograms.items()}}
+
+    def write_json(self, filename: str, run_stats: dict = None):
+        with open(filename, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(run_stats), file, indent=2, default=str)
+
+    def prometheus_text(self, run_stats: dict = None) -> str:
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        prefix = RunMetrics.PROMETHEUS_PREFIX
+        lines = []
+        numeric_stats = {name.rstrip(":"): value for name, value in (run_stats or {}).items()
+                         if isinstance(value, (int, float)) and not isinstance(value, bool)}
+        with self.lock:
+            for name, value in sorted((numeric_stats | self.counters).items()):
+                lines.append(f"# TYPE {prefix}{name} gauge")
+                lines.append(f"{prefix}{name} {value}")
+            for name, histogram in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{prefix}{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}{name}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{prefix}{name}_sum {histogram.sum}")
+                lines.append(f"{prefix}{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename: str, run_stats: dict = None):
+        with open(filename, "w", encoding="utf-8") as file:
+            file.write(self.prometheus_text(run_stats))
@@ -0,0 +1,171 @@
+from news_sender import NewsSender
+from news_fetcher import NewsFetcher
+from subscriptions import Subscriptions
+from sharding import Shard
+from datetime import date, datetime, timedelta
+import logging
+import os
+import time
+
+
+class DeliveryWindow:
+    """
+    Spreads a run's sends over window_sec seconds from its start, to smooth
+    out the load on the email provider (and stay under its throttling).  Each
+    subscriber gets a slot in the window from a stable hash of their email
+    address, so they get their email at about the same time every day.
+    """
+
+    SLOTS = 1 << 16
+
+    def __init__(self, start_time: float, window_sec: float, clock=time.time,
+                 sleep=time.sleep):
+        self.start_time = start_time
+        self.window_sec = window_sec
+        self.clock = clock
+        self.sleep = sleep
+
+    def send_time(self, subscription_rec) -> float:
+        slot = Shard.email_hash(subscription_rec.email_address) % DeliveryWindow.SLOTS
+        return self.start_time + self.window_sec * slot / DeliveryWindow.SLOTS
+
+    def order(self, subscription_recs) -> list:
+        """
+        :return: the subscription records, in order of their send times
+        """
+        return sorted(subscription_recs, key=self.send_time)
+
+
+class NewsDaemon:
+    """
+    Stays resident and does the run once a day, at daemon_run_time, instead
+    of paying the full startup (imports, config, SMTP login) on every run
+    from a scheduler.
+
+    Between runs it keeps the NewsSender, with its logged-in SMTP pool, and
+    the NewsFetcher, with its HTTP session and article cache, open.  Every
+    daemon_poll_sec it checks whether the config file or the subscriptions
+    file has changed: a changed config gets a new NewsSender and fetcher
+    (and so a new SMTP login), changed subscriptions are loaded again for the
+    next run.  The API, cache and SMTP counters in each run's final stats are
+    since the last (re)load, since those objects are kept between runs.
+
+    With a delivery_window_sec, each run's sends are spread over that many
+    seconds, see DeliveryWindow.
+
+    Each run resumes from the journal (if configured), so restarting the
+    daemon on a day it has already run doesn't mail anyone twice.
+
+    The clock and sleep functions can be swapped out, so the daemon can be
+    driven through days in a test against stub news API and SMTP servers.
+    """
+
+    def __init__(self, config_filename: str = NewsSender.CONFIG_FILENAME, shard: Shard = None,
+                 clock=time.time, sleep=time.sleep):
+        self.config_filename = config_filename
+        self.shard = shard
+        self.clock = clock
+        self.sleep = sleep
+        self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
+        self.subs: Subscriptions = None
+        self.config_stat: tuple = None
+        self.subscriptions_stat: tuple = None
+        self.subscription_recs: list = None
+        self.last_run_day: date = None
+        self.runs = 0
+        self.stopped = False
+
+    @staticmethod
+    def file_stat(filename: str) -> tuple:
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def reload_if_changed(self):
+        """
+        (Re)load the config and subscriptions, if they're new or have changed
+        """
+        config_stat = NewsDaemon.file_stat(self.config_filename)
+        if self.subs is None or config_stat != self.config_stat:
+            if self.subs is not None:
+                self.logger.info(f"Config file {self.config_filename} changed, reloading")
+                self.close()
+            self.subs = Subscriptions(self.config_filename)
+            self.subs.shard = self.shard
+            self.subs.fetcher = NewsFetcher(self.subs.newssender)
+            self.subs.keep_connection = True
+            self.config_stat = config_stat
+            self.subscription_recs = None
+        subscriptions_file = self.subs.newssender.subscriptions_excel_file
+        subscriptions_stat = NewsDaemon.file_stat(subscriptions_file)
+        if self.subscription_recs is None or subscriptions_stat != self.subscriptions_stat:
+            self.subscription_recs = list(self.subs.iter_subscriptions())
+            self.subscriptions_stat = subscriptions_stat
+            self.logger.info(f"Loaded {len(self.subscription_recs)} subscriptions "
+                             f"from {subscriptions_file}")
+
+    def next_run_time(self) -> float:
+        """
+        :return: time of the next run, today's run time if there hasn't been
+            a run today yet (even if that's already past), else tomorrow's
+        """
+        today = date.fromtimestamp(self.clock())
+        run_day = today if self.last_run_day != today else today + timedelta(days=1)
+        hour, minute = (int(part) for part in self.subs.newssender.daemon_run_time.split(":"))
+        return datetime.combine(run_day, datetime.min.time()).replace(
+            hour=hour, minute=minute).timestamp()
+
+    def run_once(self) -> dict:
+        """
+        Do a run now
+        :return: the run's final stats
+        """
+        newssender = self.subs.newssender
+        start_time = self.clock()
+        today = date.fromtimestamp(start_time)
+        newssender.start_run(today)
+        self.logger.info(f">>>>>>>> Daemon run {self.runs + 1}, news for {newssender.date_str}")
+        subscription_recs = self.subscription_recs
+        self.subs.delivery_window = None
+        if newssender.delivery_window_sec > 0:
+            self.subs.delivery_window = DeliveryWindow(start_time, newssender.delivery_window_sec,
+                                                       self.clock, self.sleep)
+            subscription_recs = self.subs.delivery_window.order(subscription_recs)
+        self.subs.subscriptions_array = subscription_recs
+        try:
+            return self.subs.process_subscriptions(resume=newssender.journal_file != "")
+        finally:
+            self.last_run_day = today
+            self.runs += 1
+
+    def run_forever(self, max_runs: int = None):
+        """
+        Run once a day until stopped
+        :param max_runs: stop after this many runs, None to keep going
+        """
+        self.logger.info(f"Daemon started, config {self.config_filename}")
+        while not self.stopped and (max_runs is None or self.runs < max_runs):
+            self.reload_if_changed()
+            wait_sec = self.next_run_time() - self.clock()
+            if wait_sec > 0:
+                self.sleep(min(wait_sec, self.subs.newssender.daemon_poll_sec))
+                continue
+            try:
+                self.run_once()
+            except Exception as ex:
+                # one bad run mustn't take the daemon down; tomorrow's run resumes
+                self.logger.exception(f"Daemon run failed: {ex}")
+        self.close()
+        self.logger.info("Daemon stopped")
+
+    def stop(self):
+        self.stopped = True
+
+    def close(self):
+        if self.subs is None:
+            return
+        self.subs.fetcher.close()
+        self.subs.newssender.close_connection()
+        self.subs = None
@@ -0,0 +1,141 @@
+from news_sender import NewsSender
+import sqlite3
+import threading
+import time
+import json
+import logging
+
+
+class SendJournal:
+    """
+    Durable, append-only journal of a run's progress, in an SQLite file: the
+    fetch/render/send state of each subscriber, keyed by email address and
+    news date, and the news fetched for each topic.  If a run dies partway
+    through, a --resume run skips the subscribers already sent to, and reuses
+    the topic news already fetched, instead of starting over and double-mailing
+    everyone.
+
+    So the journal doesn't slow the run down, writes are batched: they're
+    queued in memory and committed in one transaction when journal_batch_size
+    of them are waiting, or every journal_flush_sec seconds by a background
+    thread, whichever comes first.  A crash can lose at most the last
+    unflushed batch.
+    """
+
+    STATE_FETCHED = "fetched"
+    STATE_RENDERED = "rendered"
+    STATE_SENT = "sent"
+    # written to the spool, not delivered yet: a resumed run doesn't skip it
+    STATE_SPOOLED = "spooled"
+    STATE_FAILED = "failed"
+
+    def __init__(self, journal_file: str, run_date: str, batch_size: int, flush_sec: float):
+        self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
+        self.run_date = run_date
+        self.batch_size = max(1, batch_size)
+        self.flush_sec = flush_sec
+        self.lock = threading.Lock()
+        self.pending_states: list[tuple] = []
+        self.pending_topics: list[tuple] = []
+        self.writes = 0
+        self.flushes = 0
+        self.connection = sqlite3.connect(journal_file, check_same_thread=False,
+                                          timeout=30.0)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS subscriber_state ("
+                                "run_date TEXT NOT NULL, "
+                                "email TEXT NOT NULL, "
+                                "state TEXT NOT NULL, "
+                                "updated REAL NOT NULL, "
+                                "PRIMARY KEY (run_date, email))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS topic_news ("
+                                "run_date TEXT NOT NULL, "
+                                "topic_key TEXT NOT NULL, "
+                                "news TEXT NOT NULL, "
+                                "PRIMARY KEY (run_date, topic_key))")
+        self.connection.commit()
+        self.stop_flushing = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_periodically, name="journal-flush",
+                                        daemon=True)
+        self.flusher.start()
+
+    def start_over(self):
+        """
+        Forget any earlier run for this news date, for a run that isn't resuming
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM subscriber_state WHERE run_date = ?",
+                                    (self.run_date,))
+            self.connection.execute("DELETE FROM topic_news WHERE run_date = ?",
+                                    (self.run_date,))
+            self.connection.commit()
+
+    def sent_emails(self) -> set[str]:
+        """
+        :return: email addresses already sent to, for this news date
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT email FROM subscriber_state "
+                                           "WHERE run_date = ? AND state = ?",
+                                           (self.run_date, SendJournal.STATE_SENT)).fetchall()
+        return {row[0] for row in rows}
+
+    def fetched_topics(self) -> dict:
+        """
+        :return: dict of topic key -> news already fetched, for this news date
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT topic_key, news FROM topic_news "
+                                           "WHERE run_date = ?", (self.run_date,)).fetchall()
+        return {tuple(json.loads(topic_key)): json.loads(news) for topic_key, news in rows}
+
+    def record_state(self, email_address: str, state: str):
+        with self.lock:
+            self.pending_states.append((self.run_date, email_address, state, time.time()))
+            full = len(self.pending_states) + len(self.pending_topics) >= self.batch_size
+        if full:
+            self.flush()
+
+    def record_topic(self, topic_key: tuple, news: dict):
+        with self.lock:
+            self.pending_topics.append((self.run_date, json.dumps(topic_key), json.dumps(news)))
+            full = len(self.pending_states) + len(self.pending_topics) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit all the queued writes in one transaction
+        """
+        with self.lock:
+            if len(self.pending_states) == 0 and len(self.pending_topics) == 0:
+                return
+            states, self.pending_states = self.pending_states, []
+            topics, self.pending_topics = self.pending_topics, []
+            try:
+                with self.connection:
+                    self.connection.executemany("INSERT OR REPLACE INTO subscriber_state "
+                                                "VALUES (?, ?, ?, ?)", states)
+                    self.connection.executemany("INSERT OR REPLACE INTO topic_news "
+                                                "VALUES (?, ?, ?)", topics)
+            except sqlite3.Error as ex:
+                self.logger.error(f"Could not write {len(states) + len(topics)} "
+                                  f"journal entries: {ex}")
+                return
+            self.writes += len(states) + len(topics)
+            self.flushes += 1
+
+    def flush_periodically(self):
+        while not self.stop_flushing.wait(self.flush_sec):
+            self.flush()
+
+    def stats(self) -> dict:
+        return {"journal_writes": self.writes,
+                "journal_flushes": self.flushes}
+
+    def close(self):
+        self.stop_flushing.set()
+        self.flusher.join()
+        self.flush()
+        with self.lock:
+            self.connection.close()
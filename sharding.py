@@ -0,0 +1,123 @@
+from news_sender import NewsSender
+from send_journal import SendJournal
+import hashlib
+import logging
+
+
+class Shard:
+    """
+    One slice of the subscriber list, picked by a stable hash of the email
+    address, so a nightly run can be split across several boxes
+    (main.py --shard i/N) without them coordinating.  A shard can itself be
+    split between local worker processes (main.py --workers W): worker w of
+    W takes the subscribers of the shard with (hash // N) % W == w.
+    """
+
+    def __init__(self, index: int = 0, count: int = 1, worker_index: int = 0,
+                 worker_count: int = 1):
+        if not (0 <= index < count and 0 <= worker_index < worker_count):
+            raise ValueError(f"bad shard {index}/{count}, worker {worker_index}/{worker_count}")
+        self.index = index
+        self.count = count
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+
+    @classmethod
+    def parse(cls, shard_spec: str) -> "Shard":
+        """
+        :param shard_spec: "i/N", shard i (from 0) of N
+        :return: the Shard
+        """
+        try:
+            index, count = (int(part) for part in shard_spec.split("/"))
+            return cls(index, count)
+        except ValueError:
+            raise ValueError(f"shard must be i/N with 0 <= i < N, not {shard_spec}")
+
+    @staticmethod
+    def email_hash(email_address: str) -> int:
+        # stable across processes and boxes, unlike hash()
+        digest = hashlib.blake2b(email_address.strip().lower().encode("utf-8"),
+                                 digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    def owns(self, subscription_rec) -> bool:
+        email_hash = Shard.email_hash(subscription_rec.email_address)
+        return email_hash % self.count == self.index and \
+            (email_hash // self.count) % self.worker_count == self.worker_index
+
+    def for_worker(self, worker_index: int, worker_count: int) -> "Shard":
+        return Shard(self.index, self.count, worker_index, worker_count)
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}" + \
+            (f" worker {self.worker_index}/{self.worker_count}" if self.worker_count > 1 else "")
+
+
+def run_shard(config_filename: str, shard: Shard, resume: bool) -> dict:
+    """
+    Process one shard's subscriptions, in a worker process with its own
+    NewsSender and SMTP connections.  The workers share the on-disk
+    ArticleCache, so a topic fetched by one is a cache hit for the others
+    :return: the shard's final stats
+    """
+    # imported here so the worker process does its own setup
+    from subscriptions import Subscriptions
+    subs = Subscriptions(config_filename)
+    subs.shard = shard
+    # the parent process has already cleared the journal if need be; a worker
+    # doing it would wipe out the other workers' progress
+    subs.clear_journal = False
+    subs.newssender.metrics_json_file = worker_file_name(subs.newssender.metrics_json_file,
+                                                         shard.worker_index)
+    subs.newssender.metrics_prometheus_file = worker_file_name(
+        subs.newssender.metrics_prometheus_file, shard.worker_index)
+    return subs.process_subscriptions(resume=resume)
+
+
+def worker_file_name(filename: str, worker_index: int) -> str:
+    if filename == "":
+        return filename
+    return f"{filename}.worker{worker_index}"
+
+
+def run_workers(config_filename: str, shard: Shard, worker_count: int, resume: bool) -> dict:
+    """
+    Split the shard between worker_count processes and run them
+    :return: the workers' final stats, added together
+    """
+    newssender = NewsSender(config_filename, connect=False)
+    logger = logging.getLogger(NewsSender.LOGGER_NAME)
+    if newssender.journal_file != "" and not resume:
+        journal = SendJournal(newssender.journal_file, newssender.date_str,
+                              newssender.journal_batch_size, newssender.journal_flush_sec)
+        journal.start_over()
+        journal.close()
+    logger.info(f"Starting {worker_count} worker processes for shard {shard}")
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    # spawn rather than fork, so the workers don't inherit this process's threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=worker_count, mp_context=context) as executor:
+        futures = [executor.submit(run_shard, config_filename,
+                                   shard.for_worker(worker_index, worker_count), resume)
+                   for worker_index in range(worker_count)]
+        worker_stats = [future.result() for future in futures]
+    total_stats = merge_stats(worker_stats)
+    logger.info(f"Final stats, all {worker_count} workers: {total_stats}")
+    return total_stats
+
+
+def merge_stats(stats_list: list[dict]) -> dict:
+    """
+    Add up the final stats dicts of several shards, including nested ones
+    like the per-domain send stats
+    """
+    total_stats: dict = {}
+    for stats in stats_list:
+        for name, value in stats.items():
+            if isinstance(value, dict):
+                total_stats[name] = merge_stats([total_stats.get(name, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                total_stats[name] = total_stats.get(name, 0) + value
+    return total_stats
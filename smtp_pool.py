@@ -0,0 +1,207 @@
+from concurrent.futures import Future, InvalidStateError
+from collections import namedtuple
+from domain_scheduler import DomainScheduler
+import smtplib
+import threading
+import time
+import logging
+
+# an already-serialized message, sent as is
+RawEmail = namedtuple("RawEmail", ["from_addr", "to_addrs", "data"])
+
+
+class SmtpPool:
+    """
+    Pool of authenticated SMTP connections, each owned by a worker thread that
+    drains a shared send queue.  If the server drops a session (Gmail does
+    after a few hundred messages), the worker reconnects and retries the
+    message.  Each connection is also recycled after max_msgs_per_conn
+    messages, before the server gets around to dropping it.
+
+    The send queue is a DomainScheduler, so the workers take turns between
+    the recipient domains, and a message a domain temporarily refuses (4xx)
+    is put back to try again later, with the domain slowed down.
+    """
+
+    # errors that mean the connection is no good anymore, rather than the message.
+    # Any other OSError (DNS, TLS, socket errors) is too, but SMTPException is an
+    # OSError, so that's caught after the SMTP errors
+    CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                         ConnectionError, TimeoutError)
+    # 421 is the server telling us it's closing the session
+    CLOSING_REPLY_CODE = 421
+
+    def __init__(self, connect, pool_size: int, max_msgs_per_conn: int,
+                 max_retries: int = 2, logger_name: str = "logger", metrics=None,
+                 scheduler: DomainScheduler = None):
+        """
+        :param connect: callable that returns a new, logged-in SMTP connection
+        :param pool_size: number of connections/worker threads
+        :param max_msgs_per_conn: messages sent on a connection before it's
+            replaced with a new one, 0 for no limit
+        :param max_retries: times to reconnect and retry a message if the
+            connection fails while sending it
+        :param metrics: RunMetrics to record the send latencies in, if any
+        :param scheduler: the DomainScheduler, with its rate limits; default
+            one with no limits
+        """
+        self.connect = connect
+        self.pool_size = max(1, pool_size)
+        self.max_msgs_per_conn = max_msgs_per_conn
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.logger = logging.getLogger(logger_name)
+        self.scheduler = scheduler if scheduler is not None else DomainScheduler()
+        self.stats_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.reconnects = 0
+        self.recycles = 0
+        # log in once up front, so bad credentials show up before any work is done
+        self.connections: list = [self.connect()] + [None] * (self.pool_size - 1)
+        self.msgs_on_conn: list[int] = [0] * self.pool_size
+        self.workers = [threading.Thread(target=self.send_worker, args=(i,),
+                                         name=f"smtp-send-{i}", daemon=True)
+                        for i in range(self.pool_size)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, msg) -> Future:
+        """
+        Queue a message for sending
+        :param msg: the EmailMessage, with its To/From headers set, or a RawEmail
+        :return: Future for the (bool sent successfully, status/error msg) tuple
+        """
+        future = Future()
+        self.scheduler.put(msg, future)
+        return future
+
+    def send_worker(self, idx: int):
+        while (email := self.scheduler.get()) is not None:
+            try:
+                self.send_email(idx, email)
+            except Exception as ex:
+                # a bug rather than an SMTP problem: fail the email, but keep the
+                # worker going, or everyone waiting on its emails would hang
+                self.logger.exception(f"Unexpected error sending email to {email.domain}: {ex}")
+                self.record_failure(email, ex)
+            finally:
+                self.scheduler.done()
+        self.drop_connection(idx)
+
+    def send_email(self, idx: int, email):
+        """
+        Send one email from the scheduler, and resolve its Future, unless it's
+        deferred to try again later
+        """
+        # once it's running it can't be cancelled, so no one gives up on an email
+        # that's on its way out; it already is from an earlier try if it was deferred
+        if not email.future.running() and not email.future.set_running_or_notify_cancel():
+            # whoever was waiting for it gave up, see NewsSender.wait_for_send()
+            self.scheduler.failed(email)
+            with self.stats_lock:
+                self.failed += 1
+            return
+        if 0 < self.max_msgs_per_conn <= self.msgs_on_conn[idx]:
+            self.drop_connection(idx)
+            with self.stats_lock:
+                self.recycles += 1
+        sent, status = self.send_with_retry(idx, email.msg)
+        if sent:
+            self.scheduler.sent(email)
+            SmtpPool.resolve(email.future, (sent, status))
+        elif SmtpPool.is_temporary(status) and self.scheduler.defer(email):
+            self.logger.warning(f"Email to {email.domain} deferred ({status}), will try again")
+        else:
+            self.logger.error(f"Got exception sending email: {status}")
+            self.record_failure(email, status)
+
+    def record_failure(self, email, error):
+        self.scheduler.failed(email)
+        with self.stats_lock:
+            self.failed += 1
+        SmtpPool.resolve(email.future, (False, error))
+
+    @staticmethod
+    def resolve(future: Future, result: tuple):
+        try:
+            future.set_result(result)
+        except InvalidStateError:
+            # already resolved, or cancelled by a waiter that gave up on it
+            pass
+
+    @staticmethod
+    def is_temporary(error) -> bool:
+        """
+        :return: True if the error is a 4xx reply, e.g. a rate limit or
+            greylisting, so the message can be tried again later
+        """
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return len(error.recipients) != 0 and \
+                all(400 <= code < 500 for code, _ in error.recipients.values())
+        return isinstance(error, smtplib.SMTPResponseException) and 400 <= error.smtp_code < 500
+
+    def send_with_retry(self, idx: int, msg) -> (bool, str):
+        """
+        :return: (True, status msg) if sent, (False, the last error) if not
+        """
+        error = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.connections[idx] is None:
+                    if attempt > 0:
+                        with self.stats_lock:
+                            self.reconnects += 1
+                    self.connections[idx] = self.connect()
+                send_start = time.perf_counter()
+                if isinstance(msg, RawEmail):
+                    self.connections[idx].sendmail(msg.from_addr, msg.to_addrs, msg.data)
+                else:
+                    self.connections[idx].send_message(msg)
+                if self.metrics is not None:
+                    self.metrics.observe("smtp_send_seconds", time.perf_counter() - send_start)
+                self.msgs_on_conn[idx] += 1
+                with self.stats_lock:
+                    self.sent += 1
+                return True, "no error"
+            except SmtpPool.CONNECTION_ERRORS as ex:
+                error = ex
+            except smtplib.SMTPResponseException as ex:
+                error = ex
+                if ex.smtp_code != SmtpPool.CLOSING_REPLY_CODE:
+                    break
+            except smtplib.SMTPException as ex:
+                # recipients refused, etc. - the connection is still fine
+                error = ex
+                break
+            except OSError as ex:
+                error = ex
+            self.logger.warning(f"SMTP connection {idx} lost ({error}), reconnecting")
+            self.drop_connection(idx)
+        return False, error
+
+    def drop_connection(self, idx: int):
+        connection = self.connections[idx]
+        self.connections[idx] = None
+        self.msgs_on_conn[idx] = 0
+        if connection is None:
+            return
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            # already gone, which is fine
+            pass
+
+    def stats(self) -> dict:
+        return {"emails_sent": self.sent,
+                "emails_failed": self.failed,
+                "smtp_reconnects": self.reconnects,
+                "smtp_recycles": self.recycles} | self.scheduler.stats()
+
+    def close(self):
+        """
+        Send everything still queued, then close all the connections
+        """
+        self.scheduler.close()
+        for worker in self.workers:
+            worker.join()
@@ -1,5 +1,6 @@
 from news_sender import NewsSender
-import requests
+from subscription_record import SubscriptionRecord
+from topic_cache import TopicCache
 import logging
 
 class Subscription:
@@ -12,50 +13,107 @@ class Subscription:
     manner.  Finally,, it sends the email to the subscriber
     """
 
-    IDX_FIRSTNAME = 0
-    IDX_LASTNAME = 1
-    IDX_EMAIL = 2
-    IDX_TOPIC_LIST = 3
-    NEWS_API_BASE_URL = "https://newsapi.org/v2/everything"
     NEWS_EMAIL_SUBJECT = "Your daily NewsFeed from Marvin"
 
     @classmethod
-    def process_subscription(cls, this_subs_rec: list, newssender: NewsSender) -> dict:
+    def process_subscription(cls, this_subs_rec: SubscriptionRecord, newssender: NewsSender,
+                             topic_cache: TopicCache, renderer: "EmailRenderer" = None) -> dict:
         """
-        Process one subscription, retrieving articles for each topic in the subscription
-        :param this_subs_rec: the list containing subscriber info
+        Process one subscription, retrieving articles for each topic in the subscription.
+        Runs the fetch, render and send steps one after the other; NewsPipeline
+        runs the same steps as overlapping stages for a whole run
+        :param this_subs_rec: the subscriber's SubscriptionRecord
         :param newssender: the already-connected NewsSender object that also contains
             config params
+        :param topic_cache: the run-scoped TopicCache the topic news is served from
+        :param renderer: the run-scoped EmailRenderer, if any
         :return: list with email sent OK, error msg if not, topics requested, topics processed, articles retrieved
         """
-        logger = logging.getLogger(NewsSender.LOGGER_NAME)
-        firstname: str = this_subs_rec[cls.IDX_FIRSTNAME]
-        lastname: str = this_subs_rec[cls.IDX_LASTNAME]
-        email_address: str = this_subs_rec[cls.IDX_EMAIL]
-        subscription_list: list = this_subs_rec[cls.IDX_TOPIC_LIST]
-        topics_requested = len(subscription_list)
+        fetched = cls.fetch_subscription(this_subs_rec, newssender, topic_cache)
+        email_content = cls.render_subscription(this_subs_rec, newssender, fetched, renderer)
+        return cls.send_subscription(this_subs_rec, newssender, email_content, fetched)
+
+    @classmethod
+    def fetch_subscription(cls, this_subs_rec: SubscriptionRecord, newssender: NewsSender,
+                           topic_cache: TopicCache) -> dict:
+        """
+        Fetch stage: get the news for each topic in the subscription
+        :return: dict with topics requested, topics done, articles retrieved, and
+            the news retrieved per topic
+        """
+        subscription_list: tuple = this_subs_rec.topics
         articles_retrieved, topics_done, topics_retrieved = \
-            cls.process_topics(newssender, subscription_list)
+            cls.process_topics(newssender, subscription_list, topic_cache)
+        return {"topics_requested": len(subscription_list),
+                "topics_done": topics_done,
+                "articles_retrieved": articles_retrieved,
+                "topics_retrieved": topics_retrieved}
+
+    @classmethod
+    def render_subscription(cls, this_subs_rec: SubscriptionRecord, newssender: NewsSender,
+                            fetched: dict, renderer: "EmailRenderer" = None) -> "EmailContent":
+        """
+        Render stage: build the email body from the fetched news
+        :return: the EmailContent, with the HTML email body built
+        """
         # Hack alert!!!!! circular reference avoidance by
         # importing it inline here.  Gotta love just-in-time
         # compilation
         from email_content import EmailContent
-        email_content = EmailContent(this_subs_rec, newssender)
-        email_content.build_email_content(topics_retrieved)
-        status_list = newssender.send_html_email("Your daily NewsFeed",
-                                                 email_content.body,
-                                                 [this_subs_rec[cls.IDX_EMAIL]])
+        email_content = EmailContent(this_subs_rec, newssender, renderer)
+        email_content.build_email_content(fetched["topics_retrieved"])
+        return email_content
+
+    @classmethod
+    def send_subscription(cls, this_subs_rec: SubscriptionRecord, newssender: NewsSender,
+                          email_content: "EmailContent", fetched: dict) -> dict:
+        """
+        Send stage: send the email, wait for it, and log the outcome
+        :return: list with email sent OK, error msg if not, topics requested, topics processed, articles retrieved
+        """
+        status_list = newssender.wait_for_send(
+            cls.submit_subscription(this_subs_rec, newssender, email_content))
+        return cls.subscription_sent(this_subs_rec, fetched, status_list)
+
+    @classmethod
+    def submit_subscription(cls, this_subs_rec: SubscriptionRecord, newssender: NewsSender,
+                            email_content: "EmailContent") -> "Future":
+        """
+        Queue the email for sending, without waiting for it.  In digest mode,
+        the news part of the body is shared with everyone in the same topic bucket
+        :return: Future for the (bool sent successfully, status/error msg) tuple
+        """
+        email_address: str = this_subs_rec.email_address
+        if newssender.digest_mode:
+            return newssender.submit_digest_email(
+                "Your daily NewsFeed", email_content.personal_html(),
+                cls.digest_bucket_key(newssender, this_subs_rec),
+                email_content.shared_html(), [email_address])
+        return newssender.submit_html_email("Your daily NewsFeed", email_content.body,
+                                            [email_address])
+
+    @classmethod
+    def subscription_sent(cls, this_subs_rec: SubscriptionRecord, fetched: dict,
+                          status_list) -> dict:
+        """
+        Log the outcome of the send
+        :param status_list: the send's (bool sent successfully, status/error msg)
+        :return: list with email sent OK, error msg if not, topics requested, topics processed, articles retrieved
+        """
+        logger = logging.getLogger(NewsSender.LOGGER_NAME)
+        email_address: str = this_subs_rec.email_address
         logger.info(f"{email_address}: done processing subscription")
-        logger.info(f"{email_address}: {topics_done} completed out of {topics_requested} requested; "
-                    f"{articles_retrieved} total articles retrieved")
+        logger.info(f"{email_address}: {fetched['topics_done']} completed out of "
+                    f"{fetched['topics_requested']} requested; "
+                    f"{fetched['articles_retrieved']} total articles retrieved")
         return {"email_sent": status_list[0],
                 "error_msg": status_list[1],
-                "topics_requested": topics_requested,
-                "topics_retrieved": len(topics_retrieved),
-                "articles_retrieved": articles_retrieved}
+                "topics_requested": fetched["topics_requested"],
+                "topics_retrieved": len(fetched["topics_retrieved"]),
+                "articles_retrieved": fetched["articles_retrieved"]}
 
     @classmethod
-    def process_topics(cls, newssender, subscription_list):
+    def process_topics(cls, newssender, subscription_list, topic_cache):
         topics_retrieved: dict = {}
         topics_done = 0
         articles_retrieved = 0
@@ -63,37 +121,36 @@ class Subscription:
             if topics_done == newssender.max_topics_per_subscription:
                 # don't bother the API server for excess topics in this subscription
                 break
-            topics_retrieved[topic] = cls.get_news(topic, newssender)
+            topics_retrieved[topic] = topic_cache.get(topic)
             topics_done += 1
-            articles_retrieved += len(topics_retrieved[topic]["articles"])
+        # the same article can be in several of the subscriber's topics
+        topics_retrieved = topic_cache.article_index.select(topics_retrieved,
+                                                            newssender.max_articles_per_topic)
+        for topic_news in topics_retrieved.values():
+            articles_retrieved += len(topic_news["articles"])
         return articles_retrieved, topics_done, topics_retrieved
 
     @classmethod
-    def get_news(cls, topic: str, newssender: NewsSender) -> dict:
+    def topics_to_fetch(cls, newssender: NewsSender, subscription_list) -> list:
         """
-        Get the top news articles for the topic from yesterday, return them as a
-        dict with two n-v pairs - topic name, and a list of relevant articles
-        :param topic: the topic of interest (str)
-        :param newssender: the connected NewsSender object, with contains the
-            config params
-        :return: dict with two n-v pairs - topic name & list of relevant articles
+        The topics of a subscription that will actually be looked up, i.e. no
+        more than the configured max topics per subscription
+        :param newssender: the NewsSender object with the config params
+        :param subscription_list: the subscriber's topic list
+        :return: list of topics to fetch
         """
-        # news.org free license only permits news that's >= 24 hours old
-        logger = logging.getLogger(NewsSender.LOGGER_NAME)
-        sort_by = f"&sortBy={newssender.sort_order}"
-        search_in = f"&searchin=description"
-        url = f"{cls.NEWS_API_BASE_URL}?q={topic}"
-        url += f"&from={newssender.date_str}&language=en" \
-              f"{search_in}{sort_by}" \
-              f"&pageSize={newssender.max_articles_per_topic}" \
-              f"&apiKey={newssender.news_api_key}"
-        response = requests.get(url=url, timeout=10)
-        articles = response.json()
-        articles_avail = articles["totalResults"]
-        articles_retr = len(articles["articles"])
-        logger.debug(f"Request for topic \"{topic}\":\nstatus: {response.status_code}, "
-                  f"total articles found: {articles_avail}\narticles retrieved: {articles_retr}")
-        return {"topic": f"{topic}", "articles": articles["articles"]}
+        return list(subscription_list[:newssender.max_topics_per_subscription])
+
+    @classmethod
+    def digest_bucket_key(cls, newssender: NewsSender, this_subs_rec: SubscriptionRecord) -> tuple:
+        """
+        The subscription's effective topic list, which the digest mode buckets
+        subscribers by.  Order and spelling matter: the news table lists the
+        topics as the subscriber entered them, and an article in two topics
+        is listed under the first
+        :return: the topics that will be looked up, in order
+        """
+        return tuple(cls.topics_to_fetch(newssender, this_subs_rec.topics))
 
 
 # if __name__ == '__main__':
@@ -0,0 +1,139 @@
+from subscription_record import SubscriptionRecord, TopicTable
+import csv
+import json
+import os
+
+
+class SubscriptionLoader:
+    """
+    Streams subscription records out of the subscriptions file one at a time,
+    instead of reading the whole file into memory first.  So the first
+    emails go out right away, and memory use doesn't grow with the number of
+    subscribers.
+
+    Supported file formats, by file extension:
+        - .xlsx: Excel, read with openpyxl in read-only mode.  Same layout as
+          always - first worksheet only, first row is the column names, then
+          first name, last name, email address, comma-separated topics
+        - .xls: old-style Excel, same layout, read with xlrd; xlrd has no
+          streaming mode, but only the first worksheet is loaded
+        - .csv: same columns as the Excel file, first row is the column names
+        - .jsonl: JSON Lines, one subscription object per line, with
+          "first_name", "last_name", "email" and "topics" (comma-separated
+          string, or list of strings)
+
+    Each record is a SubscriptionRecord, with its topics interned into the
+    TopicTable passed in.
+    """
+
+    EXCEL_EXTENSIONS = {".xlsx", ".xlsm"}
+    XLS_EXTENSIONS = {".xls"}
+    CSV_EXTENSIONS = {".csv"}
+    JSONL_EXTENSIONS = {".jsonl", ".ndjson"}
+
+    @classmethod
+    def iter_subscriptions(cls, filename: str, topic_table: TopicTable):
+        """
+        Generator of the subscription records in the file
+        :param filename: the subscriptions file; the extension says what format it is
+        :param topic_table: the shared table to intern the topics into
+        :return: generator of SubscriptionRecords
+        """
+        for row in cls.iter_rows(filename):
+            record = cls.make_record(row, topic_table)
+            if record is not None:
+                yield record
+
+    @classmethod
+    def iter_rows(cls, filename: str):
+        """
+        Generator of the raw data rows in the file, before validation
+        :param filename: the subscriptions file; the extension says what format it is
+        :return: generator of (first name, last name, email, topics) rows
+        """
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in cls.EXCEL_EXTENSIONS:
+            return cls.iter_excel_rows(filename)
+        elif extension in cls.XLS_EXTENSIONS:
+            return cls.iter_xls_rows(filename)
+        elif extension in cls.CSV_EXTENSIONS:
+            return cls.iter_csv_rows(filename)
+        elif extension in cls.JSONL_EXTENSIONS:
+            return cls.iter_jsonl_rows(filename)
+        raise ValueError(f"unsupported subscriptions file type: {filename}")
+
+    @classmethod
+    def iter_excel_rows(cls, filename: str):
+        # openpyxl is only needed for Excel files
+        import openpyxl
+        workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            # skip the column names row
+            next(rows, None)
+            yield from rows
+        finally:
+            workbook.close()
+
+    @classmethod
+    def iter_xls_rows(cls, filename: str):
+        # xlrd is only needed for .xls files
+        import xlrd
+        workbook = xlrd.open_workbook(filename, on_demand=True)
+        try:
+            sheet = workbook.sheet_by_index(0)
+            # skip the column names row
+            for row_index in range(1, sheet.nrows):
+                yield sheet.row_values(row_index)
+        finally:
+            workbook.release_resources()
+
+    @classmethod
+    def iter_csv_rows(cls, filename: str):
+        with open(filename, "r", newline="", encoding="utf-8") as file:
+            rows = csv.reader(file)
+            next(rows, None)
+            yield from rows
+
+    @classmethod
+    def iter_jsonl_rows(cls, filename: str):
+        with open(filename, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip() == "":
+                    continue
+                subscription = json.loads(line)
+                yield (subscription.get("first_name"), subscription.get("last_name"),
+                       subscription.get("email"), subscription.get("topics"))
+
+    @classmethod
+    def make_record(cls, row, topic_table: TopicTable) -> SubscriptionRecord:
+        """
+        Make a subscription record out of a row from the file
+        :param row: the first name, last name, email and topics values
+        :param topic_table: the shared table to intern the topics into
+        :return: the subscription record, None for rows without an email address
+        """
+        row = list(row[:4]) + [None] * (4 - len(row))
+        firstname, lastname, email_address, topics = row
+        if email_address is None or str(email_address).strip() == "":
+            return None
+        return SubscriptionRecord(cls.cell_str(firstname), cls.cell_str(lastname),
+                                  str(email_address).strip(), cls.parse_topics(topics),
+                                  topic_table)
+
+    @staticmethod
+    def cell_str(value) -> str:
+        return "" if value is None else str(value).strip()
+
+    @staticmethod
+    def parse_topics(topics) -> list[str]:
+        """
+        :param topics: comma-separated topics, or a list of them
+        :return: list of the topics, normalized, no empty ones
+        """
+        if topics is None:
+            return []
+        if isinstance(topics, str):
+            topics = topics.split(",")
+        return [topic for topic in (TopicTable.normalize(topic) for topic in topics)
+                if topic != ""]
@@ -0,0 +1,103 @@
+import re
+import threading
+import unicodedata
+
+
+class TopicTable:
+    """
+    Shared table of all the topics in the subscriptions.  Each unique topic
+    is stored once and given an integer ID, and subscription records hold the
+    IDs rather than their own copies of the strings.
+
+    Topics are normalized as they're interned: spellings that only differ
+    in case, spacing, Unicode form or surrounding quotes ("Tesla", " tesla",
+    "\"TESLA\"") are the same topic, with the same ID, so they're one news
+    query.  The topic keeps the first spelling seen, for display.
+    """
+
+    WHITESPACE = re.compile(r"\s+")
+    QUOTES = "\"'“”‘’"
+
+    def __init__(self):
+        self.topics: list[str] = []
+        # canonical topic -> ID
+        self.topic_ids: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def normalize(cls, topic: str) -> str:
+        """
+        :return: the topic as displayed and searched for: NFKC form, no
+            surrounding quotes, single spaces
+        """
+        topic = unicodedata.normalize("NFKC", str(topic))
+        return cls.WHITESPACE.sub(" ", topic).strip().strip(cls.QUOTES).strip()
+
+    @classmethod
+    def canonical(cls, topic: str) -> str:
+        """
+        :return: the key topics are matched on: normalized and casefolded
+        """
+        return cls.normalize(topic).casefold()
+
+    def intern(self, topic: str) -> int:
+        """
+        :param topic: the topic
+        :return: the topic's ID, adding it to the table if it's new
+        """
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            key = TopicTable.canonical(topic)
+            with self.lock:
+                topic_id = self.topic_ids.get(key)
+                if topic_id is None:
+                    topic_id = len(self.topics)
+                    self.topics.append(TopicTable.normalize(topic))
+                    self.topic_ids[key] = topic_id
+                # the exact spelling too, so it's found straight away next time
+                self.topic_ids.setdefault(topic, topic_id)
+        return topic_id
+
+    def topic(self, topic_id: int) -> str:
+        return self.topics[topic_id]
+
+    def __len__(self) -> int:
+        return len(self.topics)
+
+
+class SubscriptionRecord:
+    """
+    One subscription: the subscriber's name and email address, and their
+    topics as IDs into the shared TopicTable.  Records are immutable, and use
+    __slots__ to keep the per-subscriber memory down for large lists.
+    """
+
+    __slots__ = ("firstname", "lastname", "email_address", "topic_ids", "topic_table")
+
+    def __init__(self, firstname: str, lastname: str, email_address: str,
+                 topics, topic_table: TopicTable):
+        """
+        :param topics: the subscriber's topics, in their order of preference
+        :param topic_table: the table the topics are interned into
+        """
+        set_attr = super().__setattr__
+        set_attr("firstname", firstname)
+        set_attr("lastname", lastname)
+        set_attr("email_address", email_address)
+        # the same topic twice, once normalized, is only listed once
+        set_attr("topic_ids", tuple(dict.fromkeys(topic_table.intern(topic) for topic in topics)))
+        set_attr("topic_table", topic_table)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"SubscriptionRecord is immutable, can't set {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"SubscriptionRecord is immutable, can't delete {name}")
+
+    @property
+    def topics(self) -> tuple[str, ...]:
+        return tuple(self.topic_table.topic(topic_id) for topic_id in self.topic_ids)
+
+    def __repr__(self) -> str:
+        return f"SubscriptionRecord({self.firstname!r}, {self.lastname!r}, " \
+               f"{self.email_address!r}, {self.topics!r})"
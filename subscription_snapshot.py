@@ -0,0 +1,344 @@
+from news_sender import NewsSender
+from subscription_loader import SubscriptionLoader
+from subscription_record import SubscriptionRecord, TopicTable
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import struct
+
+
+class SubscriptionSnapshot:
+    """
+    Compiled binary snapshot of the subscriptions file, so a run doesn't have
+    to re-parse the whole spreadsheet when it hasn't changed.
+
+    The snapshot records the source file's size, mtime and SHA-256.  If the
+    size and mtime still match, the records are read straight out of the
+    memory-mapped snapshot.  If they don't but the hash does (the file was
+    just touched or copied), the snapshot is still used, and its size and
+    mtime updated.  Otherwise the snapshot is rebuilt: the source rows are
+    read again, but each row is hashed, and rows whose hash is in the old
+    snapshot are taken from it as they are; only the new or changed rows
+    are validated and turned into records again.
+
+    Layout, all little-endian:
+        - header, see HEADER
+        - records, one after another: the lengths of the first name, last
+          name and email address and the number of topics (RECORD_HEAD),
+          the UTF-8 strings, then the topic IDs (uint32 each)
+        - topics, the snapshot's own topic table: length (uint16) and UTF-8
+          string for each, in topic ID order
+        - index, one ROW_INDEX entry per record: the source row's hash, and
+          the offset of the record
+    """
+
+    MAGIC = b"NFSNAP\x00\x01"
+    VERSION = 1
+    # magic, version, source size, source mtime ns, source sha256, records,
+    # topics, records offset, topics offset, index offset
+    HEADER = struct.Struct("<8sIQq32sQQQQQ")
+    RECORD_HEAD = struct.Struct("<HHHH")
+    TOPIC_HEAD = struct.Struct("<H")
+    TOPIC_ID = struct.Struct("<I")
+    ROW_INDEX = struct.Struct("<8sQ")
+    HASH_CHUNK_SIZE = 1 << 20
+
+    def __init__(self, snapshot_file: str):
+        self.snapshot_file = snapshot_file
+        self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
+        self.loaded_from_snapshot = 0
+        self.rows_reused = 0
+        self.rows_changed = 0
+        self.rows_removed = 0
+
+    @classmethod
+    def source_stat(cls, source_file: str) -> (int, int):
+        stat = os.stat(source_file)
+        return stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def source_hash(cls, source_file: str) -> bytes:
+        sha256 = hashlib.sha256()
+        with open(source_file, "rb") as file:
+            for chunk in iter(lambda: file.read(cls.HASH_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+        return sha256.digest()
+
+    @staticmethod
+    def row_hash(row) -> bytes:
+        """
+        :return: hash of the raw row values, to spot changed rows with
+        """
+        row = list(row[:4]) + [None] * (4 - len(row))
+        row_text = "\x1f".join("" if value is None else str(value) for value in row)
+        return hashlib.blake2b(row_text.encode("utf-8"), digest_size=8).digest()
+
+    def records(self, source_file: str, topic_table: TopicTable):
+        """
+        Generator of the subscription records, from the snapshot if it's up to
+        date with the source file, else rebuilding the snapshot on the way
+        :param source_file: the subscriptions file
+        :param topic_table: the shared table to intern the topics into
+        :return: generator of SubscriptionRecords
+        """
+        source_size, source_mtime_ns = SubscriptionSnapshot.source_stat(source_file)
+        snapshot = self.open()
+        try:
+            if snapshot is not None:
+                if snapshot.source_size == source_size \
+                        and snapshot.source_mtime_ns == source_mtime_ns:
+                    self.logger.info(f"Subscriptions loaded from snapshot {self.snapshot_file}")
+                    self.loaded_from_snapshot = 1
+                    yield from snapshot.iter_records(topic_table)
+                    return
+                source_hash = SubscriptionSnapshot.source_hash(source_file)
+                if snapshot.source_sha256 == source_hash:
+                    self.logger.info(f"Subscriptions file unchanged, loaded from snapshot "
+                                     f"{self.snapshot_file}")
+                    self.loaded_from_snapshot = 1
+                    snapshot.close()
+                    self.update_source_stat(source_size, source_mtime_ns)
+                    snapshot = self.open()
+                    yield from snapshot.iter_records(topic_table)
+                    return
+            else:
+                source_hash = SubscriptionSnapshot.source_hash(source_file)
+            self.logger.info(f"Subscriptions file changed, rebuilding snapshot "
+                             f"{self.snapshot_file}")
+            yield from self.rebuild(source_file, (source_size, source_mtime_ns, source_hash),
+                                    snapshot, topic_table)
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+
+    def rebuild(self, source_file: str, source_id: tuple, old_snapshot: "SnapshotReader",
+                topic_table: TopicTable):
+        """
+        Generator of the subscription records from the source file, writing
+        them to a new snapshot as it goes.  Rows unchanged since the old
+        snapshot are taken from it rather than validated again
+        :param source_id: the source file's size, mtime ns and SHA-256
+        :param old_snapshot: the out of date snapshot, None if there isn't one
+        """
+        old_rows = old_snapshot.row_offsets() if old_snapshot is not None else {}
+        rows_seen = set()
+        writer = SnapshotWriter(f"{self.snapshot_file}.{os.getpid()}.tmp")
+        try:
+            for row in SubscriptionLoader.iter_rows(source_file):
+                row_hash = SubscriptionSnapshot.row_hash(row)
+                rows_seen.add(row_hash)
+                offset = old_rows.get(row_hash)
+                if offset is not None:
+                    self.rows_reused += 1
+                    record = old_snapshot.read_record(offset, topic_table)
+                else:
+                    self.rows_changed += 1
+                    record = SubscriptionLoader.make_record(row, topic_table)
+                if record is not None:
+                    writer.add(row_hash, record)
+                    yield record
+            writer.finish(*source_id)
+        except BaseException:
+            writer.discard()
+            raise
+        self.rows_removed = len(old_rows.keys() - rows_seen)
+        os.replace(writer.filename, self.snapshot_file)
+        self.logger.info(f"Snapshot {self.snapshot_file} rebuilt: {self.rows_reused} rows "
+                         f"unchanged, {self.rows_changed} new or changed, "
+                         f"{self.rows_removed} removed")
+
+    def open(self) -> "SnapshotReader":
+        """
+        :return: the snapshot, None if there isn't one or it's unusable
+        """
+        if not os.path.exists(self.snapshot_file):
+            return None
+        try:
+            return SnapshotReader(self.snapshot_file)
+        except (OSError, ValueError, struct.error) as ex:
+            self.logger.warning(f"Ignoring unusable subscriptions snapshot "
+                                f"{self.snapshot_file}: {ex}")
+            return None
+
+    def update_source_stat(self, source_size: int, source_mtime_ns: int):
+        with open(self.snapshot_file, "r+b") as file:
+            header = list(SubscriptionSnapshot.HEADER.unpack(
+                file.read(SubscriptionSnapshot.HEADER.size)))
+            header[2] = source_size
+            header[3] = source_mtime_ns
+            file.seek(0)
+            file.write(SubscriptionSnapshot.HEADER.pack(*header))
+
+    def stats(self) -> dict:
+        return {"snapshot_loaded": self.loaded_from_snapshot,
+                "snapshot_rows_reused": self.rows_reused,
+                "snapshot_rows_changed": self.rows_changed,
+                "snapshot_rows_removed": self.rows_removed}
+
+
+class SnapshotReader:
+    """
+    Reads records straight out of a memory-mapped snapshot file
+    """
+
+    def __init__(self, filename: str):
+        with open(filename, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, self.source_size, self.source_mtime_ns, self.source_sha256,
+             self.record_count, self.topic_count, self.records_offset, self.topics_offset,
+             self.index_offset) = SubscriptionSnapshot.HEADER.unpack_from(self.mmap, 0)
+            if magic != SubscriptionSnapshot.MAGIC or version != SubscriptionSnapshot.VERSION:
+                raise ValueError("not a subscriptions snapshot, or an old version")
+            if self.index_offset + self.record_count * SubscriptionSnapshot.ROW_INDEX.size \
+                    != len(self.mmap):
+                raise ValueError("snapshot is truncated")
+            self.topics = self.read_topics()
+        except (ValueError, struct.error):
+            self.mmap.close()
+            raise
+
+    def read_topics(self) -> list[str]:
+        topics = []
+        offset = self.topics_offset
+        for _ in range(self.topic_count):
+            (length,) = SubscriptionSnapshot.TOPIC_HEAD.unpack_from(self.mmap, offset)
+            offset += SubscriptionSnapshot.TOPIC_HEAD.size
+            topics.append(self.mmap[offset:offset + length].decode("utf-8"))
+            offset += length
+        return topics
+
+    def row_offsets(self) -> dict[bytes, int]:
+        """
+        :return: dict of source row hash -> record offset
+        """
+        row_index = SubscriptionSnapshot.ROW_INDEX
+        return {row_hash: offset for row_hash, offset in
+                row_index.iter_unpack(self.mmap[self.index_offset:
+                                                self.index_offset
+                                                + self.record_count * row_index.size])}
+
+    def read_record(self, offset: int, topic_table: TopicTable) -> SubscriptionRecord:
+        firstname_len, lastname_len, email_len, topic_count = \
+            SubscriptionSnapshot.RECORD_HEAD.unpack_from(self.mmap, offset)
+        offset += SubscriptionSnapshot.RECORD_HEAD.size
+        firstname = self.mmap[offset:offset + firstname_len].decode("utf-8")
+        offset += firstname_len
+        lastname = self.mmap[offset:offset + lastname_len].decode("utf-8")
+        offset += lastname_len
+        email_address = self.mmap[offset:offset + email_len].decode("utf-8")
+        offset += email_len
+        topic_ids = struct.unpack_from(f"<{topic_count}I", self.mmap, offset)
+        return SubscriptionRecord(firstname, lastname, email_address,
+                                  [self.topics[topic_id] for topic_id in topic_ids], topic_table)
+
+    def iter_records(self, topic_table: TopicTable):
+        for _, offset in SubscriptionSnapshot.ROW_INDEX.iter_unpack(
+                self.mmap[self.index_offset:
+                          self.index_offset
+                          + self.record_count * SubscriptionSnapshot.ROW_INDEX.size]):
+            yield self.read_record(offset, topic_table)
+
+    def close(self):
+        self.mmap.close()
+
+
+class SnapshotWriter:
+    """
+    Writes a new snapshot file, one record at a time
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.file = open(filename, "wb")
+        self.file.write(b"\0" * SubscriptionSnapshot.HEADER.size)
+        self.topic_table = TopicTable()
+        self.row_index = bytearray()
+        self.record_count = 0
+
+    def add(self, row_hash: bytes, record: SubscriptionRecord):
+        firstname = record.firstname.encode("utf-8")
+        lastname = record.lastname.encode("utf-8")
+        email_address = record.email_address.encode("utf-8")
+        topic_ids = [self.topic_table.intern(topic) for topic in record.topics]
+        self.row_index += SubscriptionSnapshot.ROW_INDEX.pack(row_hash, self.file.tell())
+        self.file.write(SubscriptionSnapshot.RECORD_HEAD.pack(len(firstname), len(lastname),
+                                                              len(email_address),
+                                                              len(topic_ids)))
+        self.file.write(firstname + lastname + email_address)
+        self.file.write(struct.pack(f"<{len(topic_ids)}I", *topic_ids))
+        self.record_count += 1
+
+    def finish(self, source_size: int, source_mtime_ns: int, source_sha256: bytes):
+        topics_offset = self.file.tell()
+        for topic in self.topic_table.topics:
+            topic_bytes = topic.encode("utf-8")
+            self.file.write(SubscriptionSnapshot.TOPIC_HEAD.pack(len(topic_bytes)))
+            self.file.write(topic_bytes)
+        index_offset = self.file.tell()
+        self.file.write(self.row_index)
+        self.file.seek(0)
+        self.file.write(SubscriptionSnapshot.HEADER.pack(
+            SubscriptionSnapshot.MAGIC, SubscriptionSnapshot.VERSION, source_size,
+            source_mtime_ns, source_sha256, self.record_count, len(self.topic_table),
+            SubscriptionSnapshot.HEADER.size, topics_offset, index_offset))
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild or inspect the compiled "
+                                                 "subscriptions snapshot")
+    parser.add_argument("command", choices=["rebuild", "inspect"])
+    parser.add_argument("--config", default=NewsSender.CONFIG_FILENAME,
+                        help=f"config file (default {NewsSender.CONFIG_FILENAME})")
+    parser.add_argument("--rows", type=int, default=5,
+                        help="number of records to show with inspect (default 5)")
+    args = parser.parse_args()
+    newssender = NewsSender(args.config, connect=False)
+    source_file = newssender.subscriptions_excel_file
+    snapshot_file = newssender.subscriptions_snapshot_file
+    if snapshot_file == "":
+        print("No subscriptions_snapshot_file configured")
+        exit(1)
+    if args.command == "rebuild":
+        if os.path.exists(snapshot_file):
+            os.remove(snapshot_file)
+        snapshot = SubscriptionSnapshot(snapshot_file)
+        record_count = sum(1 for _ in snapshot.records(source_file, TopicTable()))
+        print(f"Rebuilt {snapshot_file} from {source_file}: {record_count} subscriptions")
+        return
+    reader = SubscriptionSnapshot(snapshot_file).open()
+    if reader is None:
+        print(f"No usable snapshot {snapshot_file}")
+        exit(1)
+    try:
+        source_size, source_mtime_ns = SubscriptionSnapshot.source_stat(source_file)
+        if (source_size, source_mtime_ns) == (reader.source_size, reader.source_mtime_ns):
+            status = "up to date"
+        elif SubscriptionSnapshot.source_hash(source_file) == reader.source_sha256:
+            status = "up to date (file touched)"
+        else:
+            status = "out of date"
+        print(f"Snapshot:      {snapshot_file} ({os.path.getsize(snapshot_file)} bytes)")
+        print(f"Source:        {source_file}, {status}")
+        print(f"Source SHA256: {reader.source_sha256.hex()}")
+        print(f"Subscriptions: {reader.record_count}")
+        print(f"Topics:        {reader.topic_count}")
+        for record in reader.iter_records(TopicTable()):
+            if args.rows <= 0:
+                break
+            print(f"  {record}")
+            args.rows -= 1
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
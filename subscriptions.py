@@ -1,8 +1,17 @@
 from news_sender import NewsSender
-from subscription import Subscription
-import pandas as pd
-import numpy as np
+from topic_cache import TopicCache
+from news_fetcher import NewsFetcher
+from news_pipeline import NewsPipeline
+from subscription_loader import SubscriptionLoader
+from subscription_record import TopicTable
+from topic_index import TopicIndex
+from email_renderer import EmailRenderer
+from send_journal import SendJournal
+from sharding import Shard
+from subscription_snapshot import SubscriptionSnapshot
 import logging
+import os
+import re
 
 
 class Subscriptions:
@@ -20,35 +29,131 @@ class Subscriptions:
             email address
             comma-separated list of topics
     Name and location of the Excel spreadsheet file are a configuration parameter
-    in config.json2
+    in config.json2.  The file can also be CSV or JSON Lines, see SubscriptionLoader.
+
+    The subscriptions are streamed from the file straight into the processing
+    pipeline, see iter_subscriptions().  load_subscriptions() instead reads the
+    whole (Excel) file in up front with pandas.  Either way, each subscription
+    is a SubscriptionRecord, with the topics interned in one shared TopicTable.
     '''
 
-    IDX_FIRSTNAME = 0
-    IDX_LASTNAME = 1
-    IDx_EMAIL = 2
-    IDX_TOPIC_LIST = 3
+    EMAIL_PATTERN = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
 
     # TODO: check topic list for illegal chars, HTML, etc.?  Although, in
     #  theory this would have been done in the web form where the user was
     #  managing their topic list
 
-    def __init__(self):
-        # array of subscription arrays
-        self.newssender = NewsSender()
-        pd.set_option('display.max_columns', None)
-        pd.set_option('max_colwidth', None)
-        pd.set_option('display.max_rows', None)
-        # pd.set_option('display.max_seq_items', None)
-        pd.set_option('display.width', None)
-        self.subscriptions_array = None
+    def __init__(self, config_filename: str = NewsSender.CONFIG_FILENAME, connect: bool = True):
+        """
+        :param config_filename: the config file to load
+        :param connect: False to just load the config, without connecting to
+            the email server, e.g. to check the subscriptions
+        """
+        self.newssender = NewsSender(config_filename, connect)
+        # list of SubscriptionRecords, if loaded up front
+        self.subscriptions_array: list = None
+        self.topic_table = TopicTable()
+        # just process this slice of the subscribers, if set
+        self.shard: Shard = None
+        # False if something else (e.g. the parent of worker processes) looks
+        # after clearing the journal for a new run
+        self.clear_journal = True
+        self.snapshot: SubscriptionSnapshot = None
+        # for a long-running process (see NewsDaemon): a NewsFetcher kept
+        # open between runs, whether to keep the email connections open after
+        # a run, and the DeliveryWindow to spread the sends over
+        self.fetcher: NewsFetcher = None
+        self.keep_connection = False
+        self.delivery_window = None
         self.data_columns_names: list[str] = None
         self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
-        self.load_subscriptions()
+
+    def iter_subscriptions(self):
+        ''' Stream the subscriptions from the configured file, one record at
+        a time.  If a subscriptions_snapshot_file is configured, they come from
+        the compiled snapshot while the file is unchanged, see
+        SubscriptionSnapshot
+        '''
+        try:
+            if self.newssender.subscriptions_snapshot_file != "":
+                self.snapshot = SubscriptionSnapshot(self.newssender.subscriptions_snapshot_file)
+                yield from self.snapshot.records(self.newssender.subscriptions_excel_file,
+                                                 self.topic_table)
+            else:
+                yield from SubscriptionLoader.iter_subscriptions(
+                    self.newssender.subscriptions_excel_file, self.topic_table)
+        except Exception as ex:
+            self.logger.critical(f"Error loading in the subscriptions from file "
+                  f"{self.newssender.subscriptions_excel_file}: {ex}")
+            exit(1)
+
+    def check_subscriptions(self) -> dict:
+        ''' Read and check every row of the subscriptions file, without
+        fetching any news or sending any email.  Problems are logged as
+        warnings, with the row number
+        :return: dict of counts: rows read, good subscriptions, rows without
+            an email address, bad and duplicate email addresses, subscriptions
+            with no topics or more than max_topics_per_subscription, and unique
+            topics
+        '''
+        filename = self.newssender.subscriptions_excel_file
+        stats = {"rows": 0,
+                 "subscriptions": 0,
+                 "rows_without_email": 0,
+                 "bad_emails": 0,
+                 "duplicate_emails": 0,
+                 "no_topics": 0,
+                 "too_many_topics": 0,
+                 "unique_topics": 0}
+        emails_seen = set()
+        try:
+            # row 1 is the column names, except in JSON Lines files
+            first_row = 1 if os.path.splitext(filename)[1].lower() \
+                in SubscriptionLoader.JSONL_EXTENSIONS else 2
+            for row_number, row in enumerate(SubscriptionLoader.iter_rows(filename), first_row):
+                stats["rows"] += 1
+                subscription_rec = SubscriptionLoader.make_record(row, self.topic_table)
+                if subscription_rec is None:
+                    stats["rows_without_email"] += 1
+                    continue
+                email_address = subscription_rec.email_address
+                if Subscriptions.EMAIL_PATTERN.fullmatch(email_address) is None:
+                    stats["bad_emails"] += 1
+                    self.logger.warning(f"Row {row_number}: bad email address {email_address}")
+                    continue
+                if email_address.lower() in emails_seen:
+                    stats["duplicate_emails"] += 1
+                    self.logger.warning(f"Row {row_number}: {email_address} subscribed twice")
+                    continue
+                emails_seen.add(email_address.lower())
+                if len(subscription_rec.topic_ids) == 0:
+                    stats["no_topics"] += 1
+                    self.logger.warning(f"Row {row_number}: {email_address} has no topics")
+                elif len(subscription_rec.topic_ids) > self.newssender.max_topics_per_subscription:
+                    stats["too_many_topics"] += 1
+                stats["subscriptions"] += 1
+        except Exception as ex:
+            self.logger.critical(f"Error loading in the subscriptions from file "
+                                 f"{filename}: {ex}")
+            exit(1)
+        stats["unique_topics"] = len(self.topic_table)
+        self.logger.info(f"Subscriptions check of {filename}: {stats}")
+        return stats
 
     def load_subscriptions(self):
         ''' Load the subscriptions from the configured Excel file into
-        a member array for processing
+        a member array for processing.  Reads the whole file in at once, so
+        memory use and startup time grow with the number of subscribers;
+        process_subscriptions() streams them instead unless this was called
         '''
+        # pandas (and numpy) take a good while to import, so only pay for
+        # them on this path
+        import pandas as pd
+        pd.set_option('display.max_columns', None)
+        pd.set_option('max_colwidth', None)
+        pd.set_option('display.max_rows', None)
+        # pd.set_option('display.max_seq_items', None)
+        pd.set_option('display.width', None)
         try:
             subscriptions_df = pd.read_excel(self.newssender.subscriptions_excel_file)
         except Exception as ex:
@@ -56,56 +161,129 @@ class Subscriptions:
                   f"{self.newssender.subscriptions_excel_file}: {ex}")
             exit(1)
         self.data_columns_names = list(subscriptions_df.columns)
-        self.subscriptions_array = np.array(subscriptions_df)
         if self.newssender.debug:
             self.logger.debug(f"DataFrame: {subscriptions_df}")
-            self.logger.debug(f"Array:{self.subscriptions_array}")
             self.logger.debug(f"Column names: {self.data_columns_names}")
-        # TODO: workaround to iteration antipattern with Pandas DataFrames. Need
-        #  to refactor this if subscriber list gets "large".
-        # TODO: Ardit used for index, row in iterrows(df).  I should try that
-        #   just to have the practice
-        for subscription_row in self.subscriptions_array:
-            topics_list = subscription_row[Subscriptions.IDX_TOPIC_LIST].split(",")
-            # print(topics_list)
-            for i in range(0, len(topics_list) - 1):
-                topics_list[i] = topics_list[i].strip()
-                topics_list[i].replace(" ", "+")
-            subscription_row[Subscriptions.IDX_TOPIC_LIST] = topics_list
-
-    def process_subscriptions(self) -> dict:
+        records = (SubscriptionLoader.make_record(row, self.topic_table)
+                   for row in subscriptions_df.itertuples(index=False))
+        self.subscriptions_array = [record for record in records if record is not None]
+
+    def process_subscriptions(self, resume: bool = False) -> dict:
         """
-        process all subscriptions one at a time
+        process all subscriptions, through the fetch -> render -> send stages
+        of a NewsPipeline.  Each unique topic across all the subscriptions is
+        fetched once into a run-scoped TopicCache, and each subscriber's email
+        is then assembled from that cache.  The fetches run concurrently, see
+        NewsFetcher.
+
+        Progress is recorded in the SendJournal (if one is configured), so a
+        run that dies partway through can be resumed.
+        :param resume: skip the subscribers the journal says were already sent
+            to for today's news, and reuse the topic news already fetched
         :return: list of:
         <ul>
         <li>total subscriptions</li>
         <li>subscriptions successfully processed</li>
         <li>total topics processed
         <li>total articles retrieved</li>
+        <li>unique topics fetched from the news API</li>
+        <li>topic references served from the cache</li>
         """
-        total_subscriptions = len(self.subscriptions_array)
-        subscriptions_processed_ok = 0
-        topics_requested = 0
-        topic_processed = 0
-        articles_retrieved = 0
-        for subscription_rec in self.subscriptions_array:
-            stats = Subscription.process_subscription(subscription_rec, self.newssender)
-            subscriptions_processed_ok += 1 if stats["email_sent"] else 0
-            # subscriptions_processed_ok += stats["error_msg"]
-            topics_requested += stats["topics_requested"]
-            topic_processed += stats["topics_retrieved"]
-            articles_retrieved += stats["articles_retrieved"]
-        total_stats = {
-            "subscrip_found:": len(self.subscriptions_array),
-            "subscrip_proc_ok": subscriptions_processed_ok,
-            "topics_req": topics_requested,
-            "topic_proc": topic_processed,
-            "articles_retr": articles_retrieved
-        }
-        self.newssender.close_connection()
-        self.logger.info("Email connection closed")
+        fetcher = self.fetcher if self.fetcher is not None else NewsFetcher(self.newssender)
+        topic_cache = TopicCache(self.newssender, fetcher)
+        renderer = EmailRenderer()
+        journal = self.open_journal(topic_cache, resume)
+        skip_emails = journal.sent_emails() if journal is not None and resume else None
+        if self.delivery_window is not None:
+            pipeline = NewsPipeline(self.newssender, topic_cache, renderer, journal, skip_emails,
+                                    self.delivery_window.send_time, self.delivery_window.clock,
+                                    self.delivery_window.sleep)
+        else:
+            pipeline = NewsPipeline(self.newssender, topic_cache, renderer, journal, skip_emails)
+        subscription_recs = self.subscriptions_array if self.subscriptions_array is not None \
+            else self.iter_subscriptions()
+        if self.shard is not None:
+            self.logger.info(f"Processing shard {self.shard} of the subscriptions")
+            subscription_recs = (subscription_rec for subscription_rec in subscription_recs
+                                 if self.shard.owns(subscription_rec))
+        topic_index = None
+        if self.newssender.subscription_order == "shared_topics" and self.delivery_window is None:
+            # reads all the subscriptions in before the run starts, to order it
+            topic_index = TopicIndex.build(subscription_recs, self.topic_table,
+                                           self.newssender.max_topics_per_subscription)
+            topic_cache.prefetch(topic_index.fetch_order())
+            subscription_recs = topic_index.send_order()
+            self.logger.info(f"Most-shared topics first: {topic_index.top_topics(5)}")
+        try:
+            total_stats = pipeline.run(subscription_recs)
+        finally:
+            # whatever happened, get the progress so far into the journal
+            if journal is not None:
+                journal.close()
+        if journal is not None:
+            total_stats.update(journal.stats())
+        if self.snapshot is not None:
+            total_stats.update(self.snapshot.stats())
+        if topic_index is not None:
+            total_stats.update(topic_index.stats())
+        total_stats["topics_fetched"] = topic_cache.topics_fetched
+        total_stats["topic_refs_cached"] = topic_cache.topic_refs_cached
+        total_stats.update(topic_cache.article_index.stats())
+        total_stats.update(renderer.stats())
+        total_stats.update(fetcher.stats())
+        if self.fetcher is None:
+            fetcher.close()
+        if not self.keep_connection:
+            self.newssender.close_connection()
+            self.logger.info("Email connection closed")
+        if self.newssender.smtp_pool is not None:
+            total_stats.update(self.newssender.smtp_pool.stats())
+        if self.newssender.spool is not None:
+            total_stats.update(self.newssender.spool.stats())
+        if self.newssender.digest is not None:
+            total_stats.update(self.newssender.digest.stats())
         self.logger.info(f"Final stats : {total_stats}")
+        self.write_metrics(total_stats)
         self.logger.info("<<<<<<<< Exiting after processing complete")
+        return total_stats
+
+    def open_journal(self, topic_cache: TopicCache, resume: bool) -> SendJournal:
+        """
+        Open the configured SendJournal, if any, and hook it up to the topic cache
+        :param topic_cache: the run's TopicCache
+        :param resume: if resuming, preload the topic news fetched by the earlier
+            run; if not, clear out the earlier run's journal entries
+        :return: the journal, None if not configured
+        """
+        if self.newssender.journal_file == "":
+            if resume:
+                self.logger.warning("Can't resume, no journal_file configured")
+            return None
+        journal = SendJournal(self.newssender.journal_file, self.newssender.date_str,
+                              self.newssender.journal_batch_size,
+                              self.newssender.journal_flush_sec)
+        if resume:
+            topic_cache.preload(journal.fetched_topics())
+        elif self.clear_journal:
+            journal.start_over()
+        topic_cache.journal = journal
+        return journal
+
+    def write_metrics(self, total_stats: dict):
+        """
+        Write the run's metrics, along with the final stats, to the configured
+        JSON summary and Prometheus text files
+        """
+        metrics = self.newssender.metrics
+        try:
+            if self.newssender.metrics_json_file != "":
+                metrics.write_json(self.newssender.metrics_json_file, total_stats)
+                self.logger.info(f"Metrics written to {self.newssender.metrics_json_file}")
+            if self.newssender.metrics_prometheus_file != "":
+                metrics.write_prometheus(self.newssender.metrics_prometheus_file, total_stats)
+                self.logger.info(f"Metrics written to {self.newssender.metrics_prometheus_file}")
+        except OSError as ex:
+            self.logger.error(f"Could not write the metrics: {ex}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app is flat modules at the top of the repo, as main.py runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
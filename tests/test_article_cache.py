@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+from article_cache import ArticleCache
+from news_sources import NewsApiSource
+from run_metrics import RunMetrics
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, body: dict = None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self) -> dict:
+        return self.body
+
+
+class EvictingSession:
+    """ Answers 304, evicting the entry first, as another thread's put() might """
+
+    def __init__(self, cache: ArticleCache, cache_key: str, articles: list):
+        self.cache = cache
+        self.cache_key = cache_key
+        self.articles = articles
+        self.requests = []
+
+    def get(self, url, params, headers, timeout):
+        self.requests.append(headers)
+        if headers is not None:
+            with self.cache.lock:
+                self.cache.connection.execute("DELETE FROM responses")
+            return FakeResponse(304)
+        return FakeResponse(200, {"totalResults": len(self.articles), "articles": self.articles})
+
+
+def test_revalidated_entry_that_was_evicted(tmp_path):
+    cache = ArticleCache(str(tmp_path / "cache.sqlite"), ttl_sec=60, max_entries=10)
+    assert cache.revalidated("gone") is None
+    assert cache.stats()["cache_revalidated"] == 0
+
+
+def test_search_fetches_again_when_revalidated_entry_was_evicted(tmp_path):
+    clock = [0.0]
+    newssender = SimpleNamespace(fetch_requests_per_sec=0.0, fetch_max_retries=0,
+                                 cache_file=str(tmp_path / "cache.sqlite"), cache_ttl_sec=60,
+                                 cache_max_entries=10, date_str="2024-01-01",
+                                 sort_order="relevancy", news_api_key="key",
+                                 news_api_base_url="http://news.example.com/v2/everything",
+                                 metrics=RunMetrics())
+    source = NewsApiSource(newssender)
+    source.cache.clock = lambda: clock[0]
+    stale = [{"title": "Old", "url": "https://a.com/old"}]
+    fresh = [{"title": "New", "url": "https://a.com/new"}]
+    cache_key = ArticleCache.make_key(
+        {"url": newssender.news_api_base_url} |
+        {k: v for k, v in source.query_params(["Tesla"], 10).items() if k != "apiKey"})
+    source.cache.put(cache_key, {"articles": stale}, etag='"v1"')
+    clock[0] = 120.0
+    source.session = EvictingSession(source.cache, cache_key, fresh)
+    assert source.search(["Tesla"], 10) == fresh
+    assert source.session.requests == [{"If-None-Match": '"v1"'}, None]
@@ -0,0 +1,39 @@
+from article_index import ArticleIndex
+
+
+def article(url: str, title: str, source: str = "Fake News") -> dict:
+    return {"source": {"name": source}, "title": title, "description": "", "url": url}
+
+
+def test_reordered_titles_stay_separate():
+    index = ArticleIndex()
+    tesla = article("https://a.com/1", "Tesla sues Ford over battery patents")
+    ford = article("https://b.com/2", "Ford sues Tesla over battery patents")
+    assert index.intern(tesla) is tesla
+    assert index.intern(ford) is ford
+    assert index.duplicates_merged == 0
+
+
+def test_same_title_from_other_sites_stays_separate():
+    index = ArticleIndex()
+    first = article("https://a.com/1", "Tesla recalls the Cybertruck again", "A News")
+    second = article("https://b.com/2", "Tesla recalls the Cybertruck again", "B News")
+    index.intern(first)
+    assert index.intern(second) is second
+
+
+def test_same_story_from_same_site_is_merged():
+    index = ArticleIndex()
+    first = article("https://a.com/story?id=1", "Tesla recalls the Cybertruck again - A News")
+    second = article("https://www.a.com/amp/story?id=1", "Tesla recalls the Cybertruck again")
+    index.intern(first)
+    assert index.intern(second) is first
+    assert index.duplicates_merged == 1
+
+
+def test_tracking_params_are_the_same_url():
+    index = ArticleIndex()
+    first = article("https://a.com/1", "One")
+    second = article("https://www.a.com/1/?utm_source=feed", "Two")
+    index.intern(first)
+    assert index.intern(second) is first
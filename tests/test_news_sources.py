@@ -0,0 +1,25 @@
+from news_sources import NewsSource
+
+
+def article(title: str, description: str = "") -> dict:
+    return {"title": title, "description": description, "url": "https://a.com/1"}
+
+
+def test_short_topic_is_not_part_of_a_word():
+    assert not NewsSource.matches("AI", article("Ford said again that sales are up"))
+    assert NewsSource.matches("AI", article("Ford bets on AI for its factories"))
+
+
+def test_topic_is_not_inside_another_name():
+    assert not NewsSource.matches("Ford", article("Oxford study on affordable housing"))
+    assert NewsSource.matches("Ford", article("Study", "Ford's new truck, on sale now"))
+
+
+def test_phrase_matches_any_case_and_spacing():
+    assert NewsSource.matches("Star Trek", article("New  star\ntrek series announced"))
+    assert not NewsSource.matches("Star Trek", article("Superstar trekking in Nepal"))
+
+
+def test_topic_ending_in_punctuation():
+    assert NewsSource.matches("C++", article("What's new in C++ 26"))
+    assert not NewsSource.matches("C++", article("Ct++ isn't a language"))
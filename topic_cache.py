@@ -0,0 +1,122 @@
+from news_sender import NewsSender
+from news_fetcher import NewsFetcher
+from article_index import ArticleIndex
+from subscription_record import TopicTable
+from concurrent.futures import Future
+import threading
+import logging
+
+
+class TopicCache:
+    """
+    Run-scoped cache of news query results, shared by every subscription
+    processed in a run.  Lots of subscribers follow the same topics, so
+    each unique topic is only sent to the news API once per run, and every
+    subscriber's email is assembled from the cached results.
+
+    Cache keys are the topic's canonical form (see TopicTable.canonical())
+    plus the query params that affect the result (date, sort order and page
+    size), so two spellings like "Tesla" and " tesla" share one entry.
+
+    The cache is safe to use from several threads.  Entries are futures, so a
+    topic whose fetch is still in flight is never fetched a second time;
+    later requests for it just wait for the first fetch to finish.
+
+    If there's a SendJournal, each topic's news is journaled when it arrives,
+    and a resumed run can preload() what an earlier run already fetched.
+
+    Articles are interned in the run's ArticleIndex as the topics are handed
+    out, so an article in several topics is kept once.
+    """
+
+    def __init__(self, newssender: NewsSender, fetcher: NewsFetcher):
+        self.newssender = newssender
+        self.fetcher = fetcher
+        self.results: dict[tuple, Future] = {}
+        self.lock = threading.Lock()
+        self.topics_fetched = 0
+        self.topic_refs_cached = 0
+        self.journal: "SendJournal" = None
+        self.article_index = ArticleIndex()
+        self.logger = logging.getLogger(NewsSender.LOGGER_NAME)
+
+    def make_key(self, topic: str) -> tuple:
+        return (TopicTable.canonical(topic), self.newssender.date_str,
+                self.newssender.sort_order, self.newssender.max_articles_per_topic,
+                self.newssender.dedup_backfill_articles)
+
+    def preload(self, fetched_topics: dict) -> int:
+        """
+        Load news fetched earlier (e.g. by the run being resumed) into the cache
+        :param fetched_topics: dict of cache key -> topic news
+        :return: number of topics loaded
+        """
+        with self.lock:
+            for key, news in fetched_topics.items():
+                future = Future()
+                future.set_result(news)
+                self.results[key] = future
+        self.logger.info(f"Preloaded {len(fetched_topics)} topics fetched earlier")
+        return len(fetched_topics)
+
+    def journal_news(self, key: tuple, future: Future):
+        if self.journal is None or future.exception() is not None:
+            return
+        news = future.result()
+        # failed fetches aren't worth keeping, a resumed run should try them again
+        if "error" not in news:
+            self.journal.record_topic(key, news)
+
+    def prefetch(self, topics) -> int:
+        """
+        Start fetching each topic not already in the cache, exactly once.
+        Doesn't wait for the fetches, they run concurrently in the background
+        :param topics: iterable of topics, duplicates are fine
+        :return: number of topics sent to the news API
+        """
+        fetched = 0
+        with self.lock:
+            for topic in topics:
+                key = self.make_key(topic)
+                if key not in self.results:
+                    future = self.fetcher.submit(topic)
+                    future.add_done_callback(
+                        lambda done, key=key: self.journal_news(key, done))
+                    self.results[key] = future
+                    fetched += 1
+            self.topics_fetched += fetched
+        if fetched != 0:
+            self.logger.debug(f"Prefetching {fetched} more topics, {len(self.results)} cached")
+        return fetched
+
+    def get(self, topic: str) -> dict:
+        """
+        Get the news for a topic, from the cache if already fetched (or being
+        fetched) this run
+        :param topic: the topic of interest
+        :return: dict with two n-v pairs - topic name & list of relevant articles
+        """
+        key = self.make_key(topic)
+        with self.lock:
+            future = self.results.get(key)
+            fetch_here = future is None
+            if fetch_here:
+                future = Future()
+                self.results[key] = future
+                self.topics_fetched += 1
+            else:
+                self.topic_refs_cached += 1
+        if fetch_here:
+            try:
+                news = self.fetcher.get_news(topic)
+            except Exception as ex:
+                # or the threads waiting for this fetch would wait forever
+                future.set_exception(ex)
+                raise
+            future.set_result(news)
+            self.journal_news(key, future)
+        elif not future.done():
+            # don't leave the topic sitting in a batch that isn't full yet
+            self.fetcher.flush(future)
+        # waits here if another thread's fetch of the topic is still in flight
+        return self.article_index.intern_news(future.result())
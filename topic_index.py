@@ -0,0 +1,128 @@
+from subscription_record import SubscriptionRecord, TopicTable
+from array import array
+import argparse
+import heapq
+
+
+class TopicIndex:
+    """
+    Inverted index of the run's subscriptions: for each topic (by its ID in
+    the TopicTable, so already normalized), the subscribers who get news for
+    it, as their positions in the list of records indexed, in a compact
+    uint32 array.  Only the topics that will actually be fetched are indexed,
+    the first max_topics_per_subscription of each subscription.
+
+    Answers "which topics cover the most subscribers" (top_topics()), and
+    drives the run's order when subscription_order is "shared_topics": the
+    topics are fetched most-shared first (fetch_order()), and the subscribers
+    are sent to in the order their topics will have arrived (send_order()),
+    so the biggest groups of emails can start going out earliest.
+    """
+
+    def __init__(self, topic_table: TopicTable, max_topics: int):
+        """
+        :param topic_table: the table the records' topic IDs are in
+        :param max_topics: topics per subscription that are fetched
+        """
+        self.topic_table = topic_table
+        self.max_topics = max_topics
+        self.subscribers: dict[int, array] = {}
+        self.records: list[SubscriptionRecord] = []
+
+    @classmethod
+    def build(cls, subscription_recs, topic_table: TopicTable, max_topics: int) -> "TopicIndex":
+        """
+        :param subscription_recs: iterable of subscription records, read once
+        :return: the index of the records
+        """
+        index = cls(topic_table, max_topics)
+        for subscription_rec in subscription_recs:
+            index.add(subscription_rec)
+        return index
+
+    def add(self, subscription_rec: SubscriptionRecord) -> int:
+        """
+        :return: the subscriber's ID in the index
+        """
+        subscriber_id = len(self.records)
+        self.records.append(subscription_rec)
+        for topic_id in subscription_rec.topic_ids[:self.max_topics]:
+            subscribers = self.subscribers.get(topic_id)
+            if subscribers is None:
+                subscribers = self.subscribers[topic_id] = array("I")
+            subscribers.append(subscriber_id)
+        return subscriber_id
+
+    def subscriber_ids(self, topic: str) -> array:
+        """
+        :param topic: the topic, in any spelling that normalizes to it
+        :return: IDs of the subscribers to the topic
+        """
+        topic_id = self.topic_table.topic_ids.get(TopicTable.canonical(topic))
+        return self.subscribers.get(topic_id, array("I"))
+
+    def subscribers_of(self, topic: str) -> list[SubscriptionRecord]:
+        return [self.records[subscriber_id] for subscriber_id in self.subscriber_ids(topic)]
+
+    def ranked_topic_ids(self, count: int = None) -> list[int]:
+        """
+        :param count: number of topics, None for all of them
+        :return: IDs of the topics with the most subscribers, most first; ties
+            go to the topic seen first
+        """
+        key = lambda topic_id: (len(self.subscribers[topic_id]), -topic_id)
+        if count is not None:
+            return heapq.nlargest(count, self.subscribers, key=key)
+        return sorted(self.subscribers, key=key, reverse=True)
+
+    def top_topics(self, count: int = None) -> list[tuple[str, int]]:
+        """
+        :param count: number of topics, None for all of them
+        :return: list of (topic, number of subscribers), most subscribers first
+        """
+        return [(self.topic_table.topic(topic_id), len(self.subscribers[topic_id]))
+                for topic_id in self.ranked_topic_ids(count)]
+
+    def fetch_order(self) -> list[str]:
+        """
+        :return: all the topics, most-shared first
+        """
+        return [self.topic_table.topic(topic_id) for topic_id in self.ranked_topic_ids()]
+
+    def send_order(self) -> list[SubscriptionRecord]:
+        """
+        :return: the records in the order their emails can be done, if the
+            topics are fetched in fetch_order(): by the rank of each
+            subscriber's last topic to arrive, then in file order
+        """
+        ranks = {topic_id: rank for rank, topic_id in enumerate(self.ranked_topic_ids())}
+        ready_ranks = [max((ranks[topic_id] for topic_id in record.topic_ids[:self.max_topics]),
+                           default=-1)
+                       for record in self.records]
+        return [self.records[subscriber_id]
+                for subscriber_id in sorted(range(len(self.records)), key=ready_ranks.__getitem__)]
+
+    def stats(self) -> dict:
+        top_topics = self.top_topics(1)
+        return {"topics_indexed": len(self.subscribers),
+                "topic_subscriptions_indexed": sum(len(subscribers)
+                                                   for subscribers in self.subscribers.values()),
+                "top_topic_subscribers": top_topics[0][1] if len(top_topics) != 0 else 0}
+
+
+if __name__ == "__main__":
+    # the subscriptions, through the same loader as a run, without connecting to anything
+    from news_sender import NewsSender
+    from subscriptions import Subscriptions
+    parser = argparse.ArgumentParser(description="Show the topics that cover the most subscribers")
+    parser.add_argument("--config", default=NewsSender.CONFIG_FILENAME,
+                        help=f"config file (default {NewsSender.CONFIG_FILENAME})")
+    parser.add_argument("--count", type=int, default=20,
+                        help="number of topics to show (default 20)")
+    args = parser.parse_args()
+    subs = Subscriptions(args.config, connect=False)
+    topic_index = TopicIndex.build(subs.iter_subscriptions(), subs.topic_table,
+                                   subs.newssender.max_topics_per_subscription)
+    print(f"{len(topic_index.records)} subscribers, {len(topic_index.subscribers)} topics")
+    for topic, subscriber_count in topic_index.top_topics(args.count):
+        print(f"{subscriber_count:>8}  {topic}")